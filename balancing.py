@@ -1,4 +1,5 @@
 import asyncio
+import os
 import time
 import traceback
 from datetime import datetime
@@ -11,72 +12,203 @@ import sys
 from core.wrappers import try_exc_regular, try_exc_async
 import random
 from core.telegram import Telegram, TG_Groups
+from core.selection import select_exchange
+from core.shadow import ShadowSink, DecisionLog
+from core.order_tracker import OrderTracker, TrackedOrder, FILLED
+from core.margin import MarginModel, venue_state
+from core.sharding import ShardCoordinator
+from core.orderbook_store import OrderbookStore
+from core.outbox import Outbox
+from core.timeseries import PositionHistory
+from core.client_adapter import make_session, timings
+from core.symbols import symbols
+from core.rate_limiter import limiter, ORDERS, MARKET, HEDGE, BALANCING
 
 config = configparser.ConfigParser()
 config.read(sys.argv[1], "utf-8")
 
 
+def use_orderbook_store(settings) -> bool:
+    """
+    Websocket tops bypass the clients, so they are off while snapshots are recorded or replayed:
+    every orderbook read has to go through the client to land in (and come back from) the log.
+    """
+    return settings.getboolean('WS_ORDERBOOKS', fallback=True) and \
+        not settings.get('SNAPSHOT_REPLAY') and not settings.get('SNAPSHOT_RECORD')
+
+
 class Balancing(BaseTask):
     __slots__ = 'clients', 'positions', 'total_position', 'disbalances', \
                 'side', 'mq', 'session', 'open_orders', 'app', \
                 'chat_id', 'chat_token', 'env', 'disbalance_id', 'average_price', \
-                'orderbooks', 'telegram', 'last_positions', 'last_tot_balance' # noqa
+                'orderbooks', 'telegram', 'last_positions', 'last_tot_balance', 'shadow', 'sink', \
+                'decisions', 'tracker', 'margin', 'shards', 'owned_shards', \
+                'books', 'drainer', 'history', 'venues', 'position_alerts', 'replay' # noqa
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, shard: int = 0, account_config: configparser.ConfigParser = None, mq=None,
+                 telegram: Telegram = None, books: OrderbookStore = None, warmup: bool = True):
+        super().__init__(account_config)
+        self.mq = mq
         self.positions = {}
         self.last_positions = {}
         self.last_tot_balance = 1
         self.__set_default()
-        self.telegram = Telegram()
+        self.telegram = telegram or Telegram()
         self.orderbooks = {}
-        self.env = config['SETTINGS']['ENV']
+        self.env = self.config['SETTINGS']['ENV']
+        self.replay = bool(self.config['SETTINGS'].get('SNAPSHOT_REPLAY'))
+        self.shadow = self.config['SETTINGS'].getboolean('SHADOW', fallback=False) or self.replay
+        self.sink = ShadowSink() if self.shadow else None
+        decisions_path = self.config['SETTINGS'].get('DECISIONS_LOG', 'decisions.bin' if self.shadow else '')
+        self.decisions = DecisionLog(decisions_path) if decisions_path else None
+        self.margin = MarginModel()
+        self.tracker = OrderTracker(publish=self.save_order_update,
+                                    reprice=self.reprice_order,
+                                    on_fill=self.on_order_fill,
+                                    on_close=self.on_order_close,
+                                    poll_interval=float(self.config['SETTINGS'].get('HEDGE_POLL', 1)),
+                                    deadline=float(self.config['SETTINGS'].get('HEDGE_DEADLINE', 10)),
+                                    max_reprices=int(self.config['SETTINGS'].get('HEDGE_REPRICES', 2)))
+        self.books = books
+        self.drainer = None
+        # {exchange: {symbol: {order ids}}}, None until the first cycle has cleared orders left by a previous run
+        self.open_orders = None
+        self.history = PositionHistory(int(self.config['SETTINGS'].get('HISTORY_POINTS', 2880)))
+        # (coin, exchange) already alerted for a big change, until the change falls back under the threshold
+        self.position_alerts = set()
+        # shadow mode publishes nothing, and must not drain the outbox of a production instance with the same config
+        if not self.shadow and \
+                (outbox_path := self.config['SETTINGS'].get('OUTBOX', f"outbox_{self.account}_{shard}.sqlite")):
+            self.outbox = Outbox(outbox_path)
+        self.venues = {}
+        self.shards = None
+        self.owned_shards = {0}
+        if (shards := int(self.config['SETTINGS'].get('SHARDS', 1))) > 1:
+            # leases and reservations of a shadow run stay out of production's coordinator
+            shards_dir = self.config['SETTINGS'].get('SHARDS_DIR', 'shards_shadow' if self.shadow else 'shards')
+            self.shards = ShardCoordinator(directory=shards_dir,
+                                           worker=shard,
+                                           shards=shards,
+                                           ttl=3 * int(self.config['SETTINGS']['TIMEOUT']) + 60)
 
-        time.sleep(15)
+        if warmup:
+            time.sleep(15)
 
     @try_exc_async
-    async def run(self, loop) -> None:
-        print('START BALANCING')
-        async with aiohttp.ClientSession() as session:
-            while True:
+    async def run(self, loop, session: aiohttp.ClientSession = None) -> None:
+        print(f"START BALANCING {self.account}")
+        if session:
+            await self.__run_cycles(loop, session)
+            return
+        async with make_session() as session:
+            await self.__run_cycles(loop, session)
+
+    async def __run_cycles(self, loop, session: aiohttp.ClientSession) -> None:
+        self.session = session
+        for client in self.clients.values():
+            client.use_session(session)
+        if self.books is None and use_orderbook_store(self.config['SETTINGS']):
+            self.books = OrderbookStore(session)
+        while True:
+            cycle_start = time.time()
+            if not self.mq or self.mq.is_closed:
                 await self.setup_mq(loop)
-                for exchange, client in self.clients.items():
-                    client.get_position()
-                await self.__close_all_open_orders()
-                await self.update_balances()
-                await self.__get_positions()
-                await self.__get_total_positions()
-                await self.send_positions_message(self.create_positions_message())
-                if self.check_for_empty_positions():
-                    await self.__balancing_positions(session)
-                else:
-                    message = f"ALERT: SIGNIFICANT POSITIONS CHANGE. SKIP BALANCING.\n"
-                    message += f"POSES: {self.positions}\nLAST POSES: {self.last_positions}"
-                    self.telegram.send_message(message, TG_Groups.Alerts)
-                print(f"MQ CLOSED")
-                await self.mq.close()
+            if self.outbox and not self.drainer:
+                self.drainer = loop.create_task(self.outbox.drain(self.publish_outbox, self.outbox_alert))
+            if self.shards:
+                self.owned_shards = self.shards.renew()
+                print(f"OWNED SHARDS: {sorted(self.owned_shards)}")
+            if not self.shadow:
+                await self.__close_open_orders()
+            if not await self.load_venues():
+                print("NO FRESH VENUE STATE FROM SHARD 0, SKIP CYCLE")
                 self.__set_default()
-                time.sleep(int(config['SETTINGS']['TIMEOUT']))
+                await asyncio.sleep(self.cycle_timeout())
+                continue
+            if self.replay and any(client.exhausted for client in self.clients.values()):
+                print("SNAPSHOT REPLAY FINISHED")
+                if self.decisions:
+                    self.decisions.close()
+                return
+            await self.__get_positions()
+            self.track_orderbooks()
+            self.margin.refresh(self.venues)
+            self.record_history()
+            await self.__get_total_positions()
+            if self.is_leader() and not self.shadow:
+                await self.send_positions_message(self.create_positions_message())
+                self.check_position_changes()
+            if self.check_for_empty_positions():
+                await self.__balancing_positions(session)
+            elif self.is_leader() and not self.shadow:
+                message = f"ALERT: SIGNIFICANT POSITIONS CHANGE. SKIP BALANCING.\n"
+                message += f"POSES: {self.positions}\nLAST POSES: {self.last_positions}"
+                self.telegram.send_message(message, TG_Groups.Alerts)
+            print(f"CYCLE TIME, S: {round(time.time() - cycle_start, 3)}")
+            print(f"TRACKED ORDERS: {self.tracker.active}")
+            print(f"RATE LIMITS: {limiter.metrics(self.account)}")
+            print(f"REQUESTS (CALLS, AVG MS, MAX MS): {timings.summary(self.account)}")
+            if self.outbox:
+                print(f"OUTBOX: {self.outbox.size()}")
+            self.__set_default()
+            await asyncio.sleep(self.cycle_timeout())
 
     @try_exc_regular
     def __set_default(self) -> None:
         self.last_positions = self.positions
         self.positions = {}
-        self.open_orders = {}
         self.total_position = 0
         self.disbalances = {}
         self.disbalance_id = uuid.uuid4()
 
+    def cycle_timeout(self) -> int:
+        # replayed cycles read recorded frames, there is nothing to wait for between them
+        return 0 if self.replay else int(self.config['SETTINGS']['TIMEOUT'])
+
+    async def publish_outbox(self, rows: list) -> list:
+        return await self.publish_batch(self.mq, rows)
+
+    def outbox_alert(self, text: str) -> None:
+        print(text)
+        self.telegram.send_message(text, TG_Groups.Alerts)
+
+    def is_leader(self) -> bool:
+        return not self.shards or self.shards.held(0)
+
+    def owns(self, coin: str) -> bool:
+        return not self.shards or self.shards.owns(coin)
+
+    @try_exc_async
+    async def load_venues(self) -> bool:
+        """
+        Positions and balances of every venue. Queried from the exchanges by a single balancer or
+        the shard 0 holder, which shares them, other shard workers read the shared copy.
+        """
+        if self.shards and not self.is_leader():
+            self.venues = self.shards.venues(max_age=2 * int(self.config['SETTINGS']['TIMEOUT']) + 30) or {}
+            return bool(self.venues)
+        for exchange, client in self.clients.items():
+            await limiter.acquire(exchange, MARKET, BALANCING)
+            await client.get_position()
+        await self.update_balances()
+        self.venues = {exchange: venue_state(client) for exchange, client in self.clients.items()}
+        if self.shards:
+            self.shards.publish_venues(self.venues)
+        return True
+
     @try_exc_async
     async def update_balances(self):
         for client_name, client in self.clients.items():
-            client.get_real_balance()
+            await limiter.acquire(client_name, MARKET, BALANCING)
+            await client.get_real_balance()
 
     @try_exc_async
     async def __get_positions(self):
-        for client_name, client in self.clients.items():
-            for symbol, position in client.get_positions().items():
-                coin = [i for i in client.markets.keys() if client.markets[i] == symbol][0]
+        for client_name, venue in self.venues.items():
+            for symbol, position in venue['positions'].items():
+                # a coin without a market on the venue has no price to value the position with
+                if not (coin := symbols.coin(client_name, symbol)) or not symbols.symbol(client_name, coin):
+                    continue
                 # orderbook = self.orderbooks[client_name][symbol]
                 position.update({'symbol': symbol})
                 if not self.positions.get(coin):
@@ -84,10 +216,45 @@ class Balancing(BaseTask):
                 else:
                     self.positions[coin].update({client_name: position})
 
+    @try_exc_regular
+    def record_history(self) -> None:
+        now = time.time()
+        seen = set()
+        for coin, exchanges in self.positions.items():
+            for exchange, position in exchanges.items():
+                self.history.add_position(now, coin, exchange, position['amount_usd'])
+                seen.add((coin, exchange))
+        # a position missing from this cycle was closed, record it as 0 so deltas see the close
+        for coin, exchange in list(self.history.positions):
+            if (coin, exchange) not in seen:
+                self.history.add_position(now, coin, exchange, 0)
+        total_balance = 0
+        for exchange in self.clients:
+            if margin := self.margin.get(exchange):
+                self.history.add_balance(now, exchange, margin.balance)
+                total_balance += margin.balance
+        self.history.add_balance(now, 'TOTAL', total_balance)
+
+    @try_exc_regular
+    def check_position_changes(self) -> None:
+        if not (threshold := float(self.config['SETTINGS'].get('POSITION_ALERT_USD', 0))):
+            return
+        window = float(self.config['SETTINGS'].get('POSITION_ALERT_WINDOW', 10)) * 60
+        message = ''
+        for key, series in self.history.positions.items():
+            if not (delta := series.delta(window)) or abs(delta) < threshold:
+                self.position_alerts.discard(key)
+            elif key not in self.position_alerts:
+                self.position_alerts.add(key)
+                message += f"\n{key[1]} {key[0]}: {int(round(delta))} USD"
+        if message:
+            self.telegram.send_message(f"ALERT: BIG POSITION CHANGE IN {int(window / 60)} MIN" + message,
+                                       TG_Groups.Alerts)
+
     @try_exc_regular
     def check_for_empty_positions(self):
-        for client in self.clients.values():
-            if not client.get_positions():
+        for venue in self.venues.values():
+            if not venue['positions']:
                 return False
         # len_new_pos = 0
         # len_old_pos = 0
@@ -99,44 +266,56 @@ class Balancing(BaseTask):
         #
         return True
 
-    @staticmethod
     @try_exc_regular
-    def get_coin(symbol: str):
-        coin = ''
-        if '_' in symbol:
-            coin = symbol.split('_')[1].upper().split('USD')[0]
-        elif '-' in symbol:
-            coin = symbol.split('-')[0]
-        elif 'USDT' in symbol:
-            coin = symbol.split('USD')[0]
-        return coin
+    def track_orderbooks(self) -> None:
+        if not self.books:
+            return
+        # books of closed positions and of coins other shard workers balance are dropped
+        self.books.follow(self.account, {(exchange, market) for coin in self.positions if self.owns(coin)
+                                         for exchange, client in self.clients.items()
+                                         if (market := client.markets.get(coin))})
 
     @try_exc_async
-    async def get_mark_price(self, coin: str) -> float:
-        clients_list = list(self.clients.values())
-        random_client = clients_list[random.randint(0, len(clients_list) - 1)]
-        if market := random_client.markets.get(coin):
-            ob = await random_client.get_orderbook_by_symbol(market)
-            if ob and ob.get('asks') and ob.get('bids'):
-                random_client.orderbook[market] = ob
-            else:
-                ob = random_client.get_orderbook(market)
-            mark_price = (ob['asks'][0][0] + ob['bids'][0][0]) / 2
-            return mark_price
+    async def get_top_of_book(self, exchange: str, symbol: str, priority: int = HEDGE) -> tuple:
+        """
+        Best bid and ask from the websocket store, REST snapshot if the store has nothing fresh
+        :return: (bid, ask)
+        """
+        if self.books and (top := self.books.top(exchange, symbol)):
+            return top
+        client = self.clients[exchange]
+        await limiter.acquire(exchange, MARKET, priority)
+        ob = await client.get_orderbook_by_symbol(symbol)
+        if ob and ob.get('asks') and ob.get('bids'):
+            client.orderbook[symbol] = ob
         else:
-            for client in clients_list:
-                if market := client.markets.get(coin):
-                    ob = await client.get_orderbook_by_symbol(market)
-                    if ob and ob.get('asks') and ob.get('bids'):
-                        client.orderbook[market] = ob
-                    else:
-                        ob = client.get_orderbook(market)
-                    mark_price = (ob['asks'][0][0] + ob['bids'][0][0]) / 2
-                    return mark_price
+            ob = client.get_orderbook(symbol)
+        if self.books:
+            self.books.remember(exchange, symbol, ob['bids'][0][0], ob['asks'][0][0])
+        return ob['bids'][0][0], ob['asks'][0][0]
+
+    @try_exc_async
+    async def get_mark_price(self, coin: str) -> float:
+        if self.books:
+            for exchange, client in self.clients.items():
+                if (market := client.markets.get(coin)) and (top := self.books.top(exchange, market)):
+                    return (top[0] + top[1]) / 2
+        exchanges = list(self.clients)
+        # replay asks the log in config order, so runs on the same log read the same frames
+        if not self.replay:
+            random_exchange = exchanges[random.randint(0, len(exchanges) - 1)]
+            if self.clients[random_exchange].markets.get(coin):
+                exchanges = [random_exchange]
+        for exchange in exchanges:
+            if market := self.clients[exchange].markets.get(coin):
+                bid, ask = await self.get_top_of_book(exchange, market, BALANCING)
+                return (ask + bid) / 2
 
     @try_exc_async
     async def __get_total_positions(self) -> None:
         for coin, exchanges in self.positions.items():
+            if not self.is_leader() and not self.owns(coin):
+                continue
             mark_price = await self.get_mark_price(coin)
             pos_sum = {'coin': 0, 'usd': 0}
             for exchange, position in exchanges.items():
@@ -174,7 +353,7 @@ class Balancing(BaseTask):
         total_balance = 0
         message += f"\n    BALANCES:"
         for exc_name, client in self.clients.items():
-            exc_bal = client.get_balance()
+            exc_bal = margin.balance if (margin := self.margin.get(exc_name)) else client.get_balance()
             message += f"\n{exc_name}, USD: {int(round(exc_bal, 0))}"
             total_balance += exc_bal
         message += f"\n    TOTAL:"
@@ -183,12 +362,18 @@ class Balancing(BaseTask):
         message += f"\nABS POSITION, USD: {abs_pos}"
         message += f"\nEFFECTIVE LEVERAGE: {round(abs_pos / total_balance, 2)}"
         for coin, disbalance in self.disbalances.items():
-            if abs(disbalance['usd']) > int(config['SETTINGS']['MIN_DISBALANCE']):
+            if abs(disbalance['usd']) > int(self.config['SETTINGS']['MIN_DISBALANCE']):
                 message += f"\nDISB, {coin}: {round(disbalance['coin'], 4)}"
                 message += f" (USD: {int(round(disbalance['usd'], 0))})"
         if total_balance / self.last_tot_balance <= 0.99:
             message += f"\n\nALERT! SIGNIFICANT BALANCE CHANGE: {self.last_tot_balance} -> {total_balance}"
         self.last_tot_balance = total_balance
+        if series := self.history.balance_series('TOTAL'):
+            window = float(self.config['SETTINGS'].get('BALANCE_ALERT_WINDOW', 60)) * 60
+            max_drop = float(self.config['SETTINGS'].get('BALANCE_ALERT_DROP', 0.02))
+            if (drawdown := series.max_drawdown(window)) >= max_drop:
+                message += f"\n\nALERT! BALANCE DRAWDOWN IN {int(window / 60)} MIN: {round(drawdown * 100, 2)}%"
+                message += f" (CHANGE, USD: {int(round(series.delta(window) or 0))})"
         return message
 
     @try_exc_async
@@ -198,122 +383,232 @@ class Balancing(BaseTask):
             "msg": message,
             'bot_token': self.chat_token
         }
-        await self.publish_message(connect=self.mq,
-                                   message=send_message,
+        await self.enqueue_message(message=send_message,
                                    routing_key=RabbitMqQueues.TELEGRAM,
                                    exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.TELEGRAM),
                                    queue_name=RabbitMqQueues.TELEGRAM)
 
+    @try_exc_regular
+    def add_open_order(self, exchange: str, symbol: str, order_id: str) -> None:
+        if self.open_orders is None:
+            return
+        self.open_orders.setdefault(exchange, {}).setdefault(symbol, set()).add(order_id)
+
+    @try_exc_regular
+    def on_order_close(self, order: TrackedOrder, result: dict) -> None:
+        if self.shards:
+            self.shards.release(f"{order.client.EXCHANGE_NAME}:{order.order_id}")
+        if (venue_orders := (self.open_orders or {}).get(order.client.EXCHANGE_NAME)) and order.symbol in venue_orders:
+            venue_orders[order.symbol].discard(order.order_id)
+            if not venue_orders[order.symbol]:
+                del venue_orders[order.symbol]
+        if (result or {}).get('status') == FILLED:
+            return
+        filled = abs((result or {}).get('factual_amount_coin') or 0)
+        if (unfilled := order.size - filled) > 0 and order.price:
+            # capacity taken when the order was placed comes back before the remainder is re-priced
+            self.margin.apply_order(order.client.EXCHANGE_NAME, order.symbol, order.side, -unfilled * order.price)
+
     @try_exc_async
-    async def __close_all_open_orders(self) -> None:
-        for _, client in self.clients.items():
-            client.cancel_all_orders()
+    async def __close_open_orders(self) -> None:
+        if self.open_orders is None:
+            if self.is_leader():
+                await asyncio.gather(*[self.__cancel_all(exchange) for exchange in self.clients])
+            self.open_orders = {}
+            return
+        open_orders, self.open_orders = self.open_orders, {}
+        await asyncio.gather(*[self.__cancel_venue(exchange, venue_orders)
+                               for exchange, venue_orders in open_orders.items() if venue_orders])
+
+    def __keep_open(self, exchange: str, symbol: str, order_ids) -> None:
+        for order_id in order_ids:
+            self.add_open_order(exchange, symbol, order_id)
 
     @try_exc_async
-    async def get_top_price_exchange(self, amount: float, exchanges: list, coin: str, side: str) -> list:
-        top_exchange = None
-        best_price = None
-        for exchange in exchanges:
-            symbol = self.clients[exchange].markets[coin]
-            tick = self.clients[exchange].instruments[symbol]['tick_size']
-            ob = await self.clients[exchange].get_orderbook_by_symbol(symbol)
-            self.clients[exchange].orderbook[symbol] = ob
-            if side == 'buy':
-                pretend_price = ob['asks'][0][0] + 5 * tick
-                top_exchange = exchange
-                if best_price:
-                    if pretend_price < best_price:
-                        top_exchange = exchange
-                        best_price = pretend_price
-                else:
-                    top_exchange = exchange
-                    best_price = pretend_price
-            else:
-                pretend_price = ob['bids'][0][0] - 5 * tick
-                top_exchange = exchange
-                if best_price:
-                    if pretend_price > best_price:
-                        top_exchange = exchange
-                        best_price = pretend_price
-                else:
-                    top_exchange = exchange
-                    best_price = pretend_price
-        if top_exchange:
-            symbol = self.clients[top_exchange].markets[coin]
-            price, size = self.clients[top_exchange].fit_sizes(best_price, amount, symbol)
-            return top_exchange, price, size
-        return None, None, None
+    async def __cancel_all(self, exchange: str) -> None:
+        await limiter.acquire(exchange, ORDERS, BALANCING, account=self.account)
+        await self.clients[exchange].cancel_all_orders()
 
-        # max_amount = max([client.expect_amount_coin for client in self.clients.values()])
-        #
-        # for client in self.clients.values():
-        #     client.expect_amount_coin = max_amount
+    @try_exc_async
+    async def __cancel_venue(self, exchange: str, venue_orders: dict) -> None:
+        """
+        Cancel the balancer's open orders on one venue by id, batched per symbol where the client can.
+        Orders still watched by the tracker stay open. Only a client with no per-order cancel gets
+        cancel_all_orders, and only while none of its orders is tracked; every id here is known,
+        rejected orders are never added to open_orders.
+        """
+        client = self.clients[exchange]
+        single = hasattr(client, 'cancel_order')
+        batch = hasattr(client, 'cancel_orders')
+        tracked = {symbol: {order_id for order_id in order_ids if self.tracker.is_tracked(exchange, order_id)}
+                   for symbol, order_ids in venue_orders.items()}
+        if not (single or batch):
+            if not self.tracker.venue_busy(exchange):
+                await limiter.acquire(exchange, ORDERS, BALANCING, account=self.account)
+            # checked again after waiting for the budget, a re-price may have placed a hedge meanwhile
+            if self.tracker.venue_busy(exchange):
+                # a venue-wide cancel would hit hedges the tracker is still re-pricing, retry next cycle
+                for symbol, order_ids in venue_orders.items():
+                    self.__keep_open(exchange, symbol, order_ids)
+                return
+            await client.cancel_all_orders()
+            return
+        for symbol, order_ids in venue_orders.items():
+            if tracked[symbol]:
+                self.__keep_open(exchange, symbol, tracked[symbol])
+                order_ids = order_ids - tracked[symbol]
+            if not order_ids:
+                continue
+            if batch:
+                await limiter.acquire(exchange, ORDERS, BALANCING, account=self.account)
+                await client.cancel_orders(symbol, list(order_ids))
+            else:
+                for order_id in order_ids:
+                    await limiter.acquire(exchange, ORDERS, BALANCING, account=self.account)
+                    await client.cancel_order(symbol, order_id)
+            if self.shards:
+                for order_id in order_ids:
+                    self.shards.release(f"{exchange}:{order_id}")
 
     @try_exc_async
     async def __balancing_positions(self, session: aiohttp.ClientSession) -> None:
         for coin, disbalance in self.disbalances.items():
-            if abs(disbalance['usd']) > int(config['SETTINGS']['MIN_DISBALANCE']):
+            if not self.owns(coin):
+                continue
+            if self.tracker.busy(coin):
+                print(f"SKIP {coin}: PREVIOUS HEDGE STILL TRACKED")
+                continue
+            if abs(disbalance['usd']) > int(self.config['SETTINGS']['MIN_DISBALANCE']):
                 print(coin, disbalance)
                 side = 'sell' if disbalance['usd'] > 0 else 'buy'
                 self.disbalance_id = uuid.uuid4()  # noqa
             else:
                 continue
-            exchange, price, size = await self.get_exchange_and_price(abs(disbalance['coin']), coin, side)
+            time_start = time.time()
+            exchange, price, size, venues = await self.get_exchange_and_price(abs(disbalance['coin']), coin, side)
             print(f"BALANCING ON {exchange=}")
             if exchange:
                 print(f"{exchange} BALANCING COIN FOR: {size}")
-                symbol = self.clients[exchange].markets[coin]
+                client = self.clients[exchange]
+                symbol = client.markets[coin]
                 client_id = f"api_balancing_{str(uuid.uuid4()).replace('-', '')[:20]}"
+                if self.shards and not self.shards.holds(coin):
+                    print(f"SKIP {coin}: SHARD LEASE LOST")
+                    continue
                 time_sent = time.time()
-                result = await self.clients[exchange].create_order(symbol=symbol, side=side, price=price, size=size,
-                                                                   session=session, client_id=client_id)
-                await self.save_orders(result, price, size, coin, side, time_sent)
-                await self.save_disbalance(coin, price)
-                await self.save_balance()
-                await self.send_balancing_message(exchange, coin, side, size, price)
+                if self.shadow:
+                    result = await self.sink.create_order(client, symbol=symbol, side=side, price=price, size=size,
+                                                          client_id=client_id)
+                else:
+                    await limiter.acquire(exchange, ORDERS, HEDGE, account=self.account)
+                    result = await client.create_order(symbol=symbol, side=side, price=price, size=size,
+                                                       session=session, client_id=client_id)
+                accepted = self.shadow or client.LAST_ORDER_ID != 'default'
+                if accepted:
+                    self.margin.apply_order(exchange, symbol, side, size * price)
+                    if self.shards:
+                        key = client_id if self.shadow else f"{exchange}:{client.LAST_ORDER_ID}"
+                        self.shards.reserve(key, exchange, side, size * price)
+                if self.decisions:
+                    self.decisions.write(coin, side, exchange, price, size, (time.time() - time_start) * 1000,
+                                         disbalance, venues)
+                if not self.shadow:
+                    await self.save_orders(result, price, size, coin, side, time_sent)
+                    if accepted:
+                        self.add_open_order(exchange, symbol, client.LAST_ORDER_ID)
+                        self.tracker.track(TrackedOrder(client, coin, symbol, side, client.LAST_ORDER_ID, client_id,
+                                                        size, price=price, parent_id=self.disbalance_id))
+                    await self.save_disbalance(coin, price)
+                    await self.save_balance()
+                    await self.send_balancing_message(exchange, coin, side, size, price)
+            elif self.decisions:
+                self.decisions.write(coin, side, None, None, None, (time.time() - time_start) * 1000,
+                                     disbalance, venues)
             await asyncio.sleep(1)
 
     @try_exc_async
-    async def get_exchange_and_price(self, size: float, coin: str, side: str) -> str:
-        exchanges = []
+    async def get_venues(self, size: float, coin: str, side: str) -> dict:
+        venues = {}
         for ex, client in self.clients.items():
             try:
-                mrkt = client.markets[coin]
+                mrkt = client.markets.get(coin)
+                if not mrkt or not client.instruments.get(mrkt):
+                    continue
                 if client.instruments[mrkt]['min_size'] <= abs(size):
-                    av_balances = client.get_available_balance()
-                    av_coin = av_balances.get(mrkt, {}).get(side)
-                    if not av_coin:
-                        av_coin = av_balances.get(side)
+                    av_coin = self.margin.available(ex, mrkt, side)
+                    if self.shards:
+                        av_coin -= self.shards.reserved(ex, side)
                     print(f"{mrkt=} {av_coin=}")
-                    if av_coin > 0:
-                        ob = await client.get_orderbook_by_symbol(mrkt)
-                        change = ob['asks'][0][0] + ob['bids'][0][0]
-                        print(f"{size=} {size * change}")
-                        if av_coin >= size * change:
-                            exchanges.append(ex)
-                        elif av_coin >= size * change * 0.99:
-                            exchanges.append(ex)
-                            size = size * 0.99
+                    if av_coin and av_coin > 0:
+                        bid, ask = await self.get_top_of_book(ex, mrkt)
+                        venues[ex] = {'min_size': client.instruments[mrkt]['min_size'],
+                                      'tick_size': client.instruments[mrkt]['tick_size'],
+                                      'available': av_coin,
+                                      'ask': ask,
+                                      'bid': bid}
             except:
                 traceback.print_exc()
-        if not len(exchanges):
-            for ex, client in self.clients.items():
-                mrkt = client.markets[coin]
-                if not client.instruments.get(mrkt) and ex == 'BITKUB':
-                    continue
-                if client.instruments[mrkt]['min_size'] <= abs(size):
-                    av_balances = client.get_available_balance()
-                    av_coin = av_balances.get(mrkt, {}).get(side)
-                    if not av_coin:
-                        av_coin = av_balances.get(side)
-                    if av_coin > 0:
-                        ob = client.get_orderbook(mrkt)
-                        change = ob['asks'][0][0] + ob['bids'][0][0]
-                        size = av_coin / change
-                        exchanges.append(ex)
-        print(exchanges)
-        top_exchange, price, size = await self.get_top_price_exchange(size, exchanges, coin, side)
-        return top_exchange, price, size
+        return venues
+
+    @try_exc_async
+    async def get_exchange_and_price(self, size: float, coin: str, side: str) -> tuple:
+        venues = await self.get_venues(size, coin, side)
+        print(list(venues))
+        top_exchange, price, size = select_exchange(venues, size, side)
+        if top_exchange:
+            symbol = self.clients[top_exchange].markets[coin]
+            price, size = self.clients[top_exchange].fit_sizes(price, size, symbol)
+        return top_exchange, price, size, venues
+
+    @try_exc_async
+    async def reprice_order(self, order: TrackedOrder, remaining: float):
+        client = order.client
+        tick = client.instruments[order.symbol]['tick_size']
+        if not (top := await self.get_top_of_book(client.EXCHANGE_NAME, order.symbol)):
+            return None
+        bid, ask = top
+        if order.side == 'buy':
+            price = ask + 5 * tick
+        else:
+            price = bid - 5 * tick
+        price, size = client.fit_sizes(price, remaining, order.symbol)
+        if not size or size < client.instruments[order.symbol]['min_size']:
+            return None
+        if self.shards and not self.shards.holds(order.coin):
+            print(f"NO REPRICE {order.coin}: SHARD LEASE LOST")
+            return None
+        client_id = f"api_balancing_{str(uuid.uuid4()).replace('-', '')[:20]}"
+        time_sent = time.time()
+        await limiter.acquire(client.EXCHANGE_NAME, ORDERS, HEDGE, account=self.account)
+        result = await client.create_order(symbol=order.symbol, side=order.side, price=price, size=size,
+                                           session=self.session, client_id=client_id)
+        print(f"{client.EXCHANGE_NAME} REPRICED {order.client_id} -> {client_id}: {size} @ {price}")
+        await self.save_orders(result, price, size, order.coin, order.side, time_sent, parent_id=order.parent_id)
+        if client.LAST_ORDER_ID == 'default':
+            return None
+        self.margin.apply_order(client.EXCHANGE_NAME, order.symbol, order.side, size * price)
+        if self.shards:
+            self.shards.reserve(f"{client.EXCHANGE_NAME}:{client.LAST_ORDER_ID}", client.EXCHANGE_NAME, order.side,
+                                size * price)
+        self.add_open_order(client.EXCHANGE_NAME, order.symbol, client.LAST_ORDER_ID)
+        return TrackedOrder(client, order.coin, order.symbol, order.side, client.LAST_ORDER_ID, client_id, size,
+                            order.attempt + 1, price=price, parent_id=order.parent_id)
+
+    @try_exc_regular
+    def on_order_fill(self, order: TrackedOrder, result: dict) -> None:
+        # capacity was taken at the order price when it was placed, only the price difference of the fill is new;
+        # client state is as old as the cycle start, reloading it would drop every other order placed since
+        filled = abs(result.get('factual_amount_coin') or 0)
+        if filled and (fill_price := result.get('factual_price')) and order.price:
+            self.margin.apply_order(order.client.EXCHANGE_NAME, order.symbol, order.side,
+                                    filled * (fill_price - order.price))
+
+    @try_exc_async
+    async def save_order_update(self, result: dict) -> None:
+        await self.enqueue_message(message=result,
+                                   routing_key=RabbitMqQueues.UPDATE_ORDERS,
+                                   exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.UPDATE_ORDERS),
+                                   queue_name=RabbitMqQueues.UPDATE_ORDERS)
 
     @try_exc_async
     async def send_balancing_message(self, exchange: str, coin: str, side: str, size: float, price: float) -> None:
@@ -327,8 +622,7 @@ class Balancing(BaseTask):
             "msg": message,
             'bot_token': self.chat_token
         }
-        await self.publish_message(connect=self.mq,
-                                   message=send_message,
+        await self.enqueue_message(message=send_message,
                                    routing_key=RabbitMqQueues.TELEGRAM,
                                    exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.TELEGRAM),
                                    queue_name=RabbitMqQueues.TELEGRAM)
@@ -342,14 +636,14 @@ class Balancing(BaseTask):
             'chat_id': self.chat_id,
             'telegram_bot': self.chat_token,
         }
-        await self.publish_message(connect=self.mq,
-                                   message=message,
+        await self.enqueue_message(message=message,
                                    routing_key=RabbitMqQueues.CHECK_BALANCE,
                                    exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.CHECK_BALANCE),
                                    queue_name=RabbitMqQueues.CHECK_BALANCE)
 
     @try_exc_async
-    async def save_orders(self, res: dict, expect_price: float, amount: float, coin: str,  side: str, time_sent: float):
+    async def save_orders(self, res: dict, expect_price: float, amount: float, coin: str,  side: str, time_sent: float,
+                          parent_id=None):
         exchange = res['exchange_name']
         client = self.clients[exchange]
         order_id = uuid.uuid4()
@@ -358,7 +652,7 @@ class Balancing(BaseTask):
             'datetime': datetime.utcnow(),
             'ts': int(time.time() * 1000),
             'context': 'balancing',
-            'parent_id': self.disbalance_id,
+            'parent_id': parent_id or self.disbalance_id,
             'exchange_order_id': client.LAST_ORDER_ID,
             'type': 'GTT' if client.EXCHANGE_NAME == 'DYDX' else 'GTC',
             'status': 'Processing',
@@ -380,21 +674,21 @@ class Balancing(BaseTask):
             'inner_ping': 0}
 
         if client.LAST_ORDER_ID == 'default':
+            if '429' in str(client.error_info):
+                limiter.penalize(exchange, ORDERS, account=self.account)
             error_message = {
                 "chat_id": self.chat_id,
                 "msg": f"ALERT NAME: Order Mistake\nCOIN: {coin}\nCONTEXT: BOT\nENV: {self.env}\nEXCHANGE: "
                        f"{client.EXCHANGE_NAME}\nOrder Id:{order_id}\nError:{client.error_info}",
                 'bot_token': self.chat_token
             }
-            await self.publish_message(connect=self.mq,
-                                       message=error_message,
+            await self.enqueue_message(message=error_message,
                                        routing_key=RabbitMqQueues.TELEGRAM,
                                        exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.TELEGRAM),
                                        queue_name=RabbitMqQueues.TELEGRAM)
             client.error_info = None
 
-        await self.publish_message(connect=self.mq,
-                                   message=message,
+        await self.enqueue_message(message=message,
                                    routing_key=RabbitMqQueues.ORDERS,
                                    exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.ORDERS),
                                    queue_name=RabbitMqQueues.ORDERS)
@@ -409,18 +703,65 @@ class Balancing(BaseTask):
             'position_coin': self.disbalances[coin]['coin'],
             'position_usd': round(self.disbalances[coin]['usd'], 1),
             'price': price,
-            'threshold': float(config['SETTINGS']['MIN_DISBALANCE']),
+            'threshold': float(self.config['SETTINGS']['MIN_DISBALANCE']),
             'status': 'Processing'
         }
 
-        await self.publish_message(connect=self.mq,
-                                   message=message,
+        await self.enqueue_message(message=message,
                                    routing_key=RabbitMqQueues.DISBALANCE,
                                    exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.DISBALANCE),
                                    queue_name=RabbitMqQueues.DISBALANCE)
 
 
 if __name__ == '__main__':
-    worker = Balancing()
-    loop = asyncio.new_event_loop()
-    loop.run_until_complete(worker.run(loop))
+    import multiprocessing
+
+    @try_exc_regular
+    def async_process(shard):
+        worker = Balancing(shard=shard)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(worker.run(loop))
+
+    @try_exc_async
+    async def run_accounts(loop, paths: list) -> None:
+        """
+        Every account config runs as its own Balancing task on one loop. Accounts share the broker
+        connection, Telegram dispatcher, HTTP session and orderbook store; positions and orders stay apart.
+        """
+        telegram = Telegram()
+        workers = []
+        for path in paths:
+            account_config = configparser.ConfigParser()
+            account_config.read(path, "utf-8")
+            if not account_config['SETTINGS'].get('ACCOUNT'):
+                # accounts sharing one ENV still need their own outbox file and order budgets
+                name = os.path.splitext(os.path.basename(path))[0]
+                account_config['SETTINGS']['ACCOUNT'] = f"{name}_{len(workers)}"
+            if int(account_config['SETTINGS'].get('SHARDS', 1)) > 1:
+                # every account here is a single worker 0, shard coordination would mix accounts in one SHARDS_DIR
+                print(f"ACCOUNT {account_config['SETTINGS']['ACCOUNT']}: SHARDS IGNORED WITH ACCOUNTS")
+                account_config['SETTINGS']['SHARDS'] = '1'
+            workers.append(Balancing(account_config=account_config, telegram=telegram, warmup=False))
+        time.sleep(15)
+        await workers[0].setup_mq(loop)
+        async with make_session() as session:
+            books = OrderbookStore(session) if use_orderbook_store(config['SETTINGS']) else None
+            for worker in workers:
+                worker.mq = workers[0].mq
+                worker.books = books
+            await asyncio.gather(*[worker.run(loop, session) for worker in workers])
+
+    shards = int(config['SETTINGS'].get('SHARDS', 1))
+    if accounts := [x.strip() for x in config['SETTINGS'].get('ACCOUNTS', '').split(',') if x.strip()]:
+        main_loop = asyncio.new_event_loop()
+        main_loop.run_until_complete(run_accounts(main_loop, accounts))
+    elif shards > 1:
+        processes = []
+        for shard in range(shards):
+            process = multiprocessing.Process(target=async_process, args=(shard,))
+            processes.append(process)
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        async_process(0)
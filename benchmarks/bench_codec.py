@@ -0,0 +1,65 @@
+"""
+Wire format benchmark: python3 -m benchmarks.bench_codec [iterations]
+"""
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from core import codec
+
+ORDERS = 'logger.event.insert_orders'
+
+
+def sample_order() -> dict:
+    return {
+        'id': uuid.uuid4(),
+        'datetime': datetime.utcnow(),
+        'ts': int(time.time() * 1000),
+        'context': 'balancing',
+        'parent_id': uuid.uuid4(),
+        'exchange_order_id': '8389765599571563042',
+        'type': 'GTC',
+        'status': 'Processing',
+        'exchange_name': 'BINANCE',
+        'side': 'buy',
+        'symbol': 'ETHUSDT',
+        'expect_price': 1874.37,
+        'expect_amount_coin': 0.253,
+        'expect_amount_usd': 0.253 * 1874.37,
+        'expect_fee': 0.00036 * 0.253 * 1874.37,
+        'factual_price': 0,
+        'factual_amount_coin': 0,
+        'factual_amount_usd': 0,
+        'factual_fee': 0.00036,
+        'order_place_time': int(time.time() * 1000),
+        'env': 'PROD',
+        'oneway_ping_orderbook': 0,
+        'oneway_ping_order': 0.0421,
+        'inner_ping': 0}
+
+
+def bench(message: dict, binary: bool, iterations: int) -> tuple:
+    body, content_type, headers = codec.encode(message, ORDERS, binary)
+    time_start = time.perf_counter()
+    for _ in range(iterations):
+        codec.encode(message, ORDERS, binary)
+    encode_us = (time.perf_counter() - time_start) / iterations * 1e6
+    time_start = time.perf_counter()
+    for _ in range(iterations):
+        codec.decode(body, content_type, headers, ORDERS)
+    decode_us = (time.perf_counter() - time_start) / iterations * 1e6
+    return len(body), encode_us, decode_us
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    message = sample_order()
+    json_body, json_type, json_headers = codec.encode(message, ORDERS)
+    binary_body, binary_type, binary_headers = codec.encode(message, ORDERS, binary=True)
+    assert codec.decode(json_body, json_type, json_headers, ORDERS) == \
+        codec.decode(binary_body, binary_type, binary_headers, ORDERS)
+    print(f"{ORDERS}, {iterations} iterations")
+    for name, binary in (('json', False), ('msgpack', True)):
+        size, encode_us, decode_us = bench(message, binary, iterations)
+        print(f"{name:8} SIZE, B: {size:5}  ENCODE, US: {encode_us:7.2f}  DECODE, US: {decode_us:7.2f}")
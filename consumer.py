@@ -3,13 +3,15 @@ import logging
 from logging.config import dictConfig
 import time
 import random
-from tasks.base_task import BaseTask
+from tasks.base_task import BaseTask, transport
 
-import orjson
 from aio_pika import connect_robust
 from aiohttp.web import Application
 from tasks.all_tasks import QUEUES_TASKS
-from core.wrappers import try_exc_async, try_exc_regular
+from core.wrappers import try_exc_async, try_exc_regular, telegram
+from core.telegram import TG_Groups
+from core import codec
+from core.memory import HandlerPool, MemoryGuard, rss_bytes
 
 
 import configparser
@@ -40,6 +42,16 @@ class Consumer:
         self.rabbit_url = f"amqp://{rabbit['USERNAME']}:{rabbit['PASSWORD']}@{rabbit['HOST']}:{rabbit['PORT']}/"  # noqa
         self.periodic_tasks = []
         self.base_task = BaseTask()
+        self.prefetch = int(config['SETTINGS'].get('CONSUMER_PREFETCH', 10))
+        self.handlers = HandlerPool({key: (lambda task=task: task(self.app, self.base_task))
+                                     for key, task in QUEUES_TASKS.items()}, max_idle=self.prefetch)
+        rss_low = config['SETTINGS'].get('RSS_LOW_MB')
+        self.guard = MemoryGuard(float(config['SETTINGS'].get('RSS_HIGH_MB', 0)), float(rss_low) if rss_low else None,
+                                 max_pause=float(config['SETTINGS'].get('RSS_MAX_PAUSE', 300)))
+        # what to do when RSS stays high for RSS_MAX_PAUSE: resume consuming, or exit for the supervisor to restart
+        self.exit_on_memory = config['SETTINGS'].get('RSS_PAUSE_ACTION', 'resume') == 'exit'
+        self.queues = {}
+        self.paused = False
 
     @try_exc_async
     async def run(self) -> None:
@@ -54,7 +66,7 @@ class Consumer:
 
         if self.queue and self.queue in QUEUES_TASKS:
             logger.info("Single work option")
-            self.periodic_tasks.append(self.loop.create_task(self._consume(self.app['mq'], self.queue)))
+            self.periodic_tasks.append(self.loop.create_task(self._consume(self.app.get('mq'), self.queue)))
 
     @try_exc_async
     async def setup_mq(self):
@@ -62,20 +74,54 @@ class Consumer:
 
     @try_exc_async
     async def _consume(self, connection, queue_name) -> None:
+        if local_queue := await transport.listen(queue_name):
+            logger.info(f"Local queue: {queue_name}")
+            self.queues[f"local:{queue_name}"] = (local_queue, await local_queue.consume(self.on_message))
+        if not connection:
+            return
         channel = await connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch)
         queue = await channel.declare_queue(queue_name, durable=True)
-        await queue.consume(self.on_message)
+        self.queues[queue_name] = (queue, await queue.consume(self.on_message))
+
+    @try_exc_async
+    async def _pause_on_memory(self) -> None:
+        """Stop taking messages above the RSS high watermark, resume under the low one"""
+        if self.paused or not self.guard.exceeded():
+            return
+        self.paused = True
+        logger.info(f"RSS {rss_bytes() // 2 ** 20} MB, pause consuming")
+        for queue_name, (queue, consumer_tag) in self.queues.items():
+            await queue.cancel(consumer_tag)
+        if not await self.guard.wait_low():
+            message = f"ALERT: CONSUMER {self.queue} RSS {rss_bytes() // 2 ** 20} MB " \
+                      f"STILL ABOVE {self.guard.low // 2 ** 20} MB AFTER {int(self.guard.max_pause)} S PAUSE"
+            message += ", EXIT" if self.exit_on_memory else ", RESUME CONSUMING"
+            logger.info(message)
+            telegram.send_message(message, TG_Groups.Alerts)
+            if self.exit_on_memory:
+                # unacked messages go back to the queue, the supervisor starts a fresh process
+                sys.exit(1)
+        for queue_name, (queue, _) in self.queues.items():
+            self.queues[queue_name] = (queue, await queue.consume(self.on_message))
+        logger.info(f"RSS {rss_bytes() // 2 ** 20} MB, resume consuming")
+        self.paused = False
 
     @try_exc_async
     async def on_message(self, message) -> None:
         logger.info(f"\n\nReceived message {message.routing_key}")
         if 'logger.periodic' in message.routing_key:
             await message.ack()
-        task = QUEUES_TASKS.get(message.routing_key)(self.app, self.base_task)
-        await task.run(orjson.loads(message.body))
+        task = self.handlers.acquire(message.routing_key)
+        try:
+            decode = codec.iter_items if getattr(task, 'LAZY_PAYLOAD', False) else codec.decode
+            await task.run(decode(message.body, message.content_type, message.headers, message.routing_key))
+        finally:
+            self.handlers.release(message.routing_key, task)
         logger.info(f"Success task {message.routing_key}")
         if 'logger.event' in message.routing_key:
             await message.ack()
+        await self._pause_on_memory()
 
 
 if __name__ == '__main__':
@@ -83,6 +129,7 @@ if __name__ == '__main__':
     # parser.add_argument('-q', nargs='?', const=True, dest='queue', default='logger.periodic.get_missed_orders')
     # args = parser.parse_args()
     import multiprocessing
+    from multiprocessing.connection import wait
 
     @try_exc_regular
     def async_process(queue):
@@ -96,13 +143,23 @@ if __name__ == '__main__':
 
     queues = config['SETTINGS']['QUEUES'].split(',')
 
-    processes = []
+    processes = {}
     for queue in queues:
         process = multiprocessing.Process(target=async_process, args=(queue,))
-        processes.append(process)
+        processes[queue] = process
         process.start()
 
-    for process in processes:
-        process.join()
+    while processes:
+        wait([process.sentinel for process in processes.values()])
+        for queue, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            if process.exitcode:
+                # a consumer exited on memory pressure or a crash, start a fresh one for its queue
+                logger.info(f"Consumer {queue} exited with {process.exitcode}, restart")
+                processes[queue] = multiprocessing.Process(target=async_process, args=(queue,))
+                processes[queue].start()
+            else:
+                del processes[queue]
 
 
@@ -0,0 +1,110 @@
+import asyncio
+import inspect
+import time
+
+import aiohttp
+
+from core.rate_limiter import limiter, EXCHANGE_HOSTS, MARKET, ORDERS
+
+# client methods that block on network I/O and have no async version
+BLOCKING = ('get_position', 'get_real_balance', 'cancel_all_orders', 'cancel_order', 'cancel_orders',
+            'get_order_by_id')
+
+
+async def _observe_response(session, context, params) -> None:
+    """429s and used-weight headers of exchange responses feed the rate limiter"""
+    if exchange := EXCHANGE_HOSTS.get(params.url.host):
+        budget = MARKET if params.method == 'GET' else ORDERS
+        limiter.observe_headers(exchange, budget, params.response.status, params.response.headers)
+
+
+def make_session() -> aiohttp.ClientSession:
+    """Shared HTTP pool: keep-alive connections, cached DNS and per-host limits"""
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60)
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(_observe_response)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=15),
+                                 trace_configs=[trace])
+
+
+class RequestTimings:
+    __slots__ = 'stats'
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, account: str, exchange: str, method: str, elapsed: float) -> None:
+        if not (stat := self.stats.get((account, exchange, method))):
+            stat = self.stats[(account, exchange, method)] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] = max(stat[2], elapsed)
+
+    def summary(self, account: str = None, reset: bool = True) -> dict:
+        """{exchange.method: (calls, avg ms, max ms)} of one account, only its entries are reset"""
+        keys = [key for key in self.stats if key[0] == account]
+        summary = {}
+        for key in keys:
+            count, total, longest = self.stats.pop(key) if reset else self.stats[key]
+            summary[f"{key[1]}.{key[2]}"] = (count, round(total / count * 1000, 1), round(longest * 1000, 1))
+        return summary
+
+
+timings = RequestTimings()
+
+
+class AsyncClient:
+    """
+    Fully async view of an exchange client. Blocking methods run in the default executor,
+    coroutine methods get the shared session when they take one and none was passed,
+    every call is timed. Everything else (markets, instruments, orderbook, ...) passes through.
+    """
+    __slots__ = '_client', '_exchange', '_session', 'account'
+    _signatures = {}
+
+    def __init__(self, client, exchange: str, session: aiohttp.ClientSession = None, account: str = None):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_exchange', exchange)
+        object.__setattr__(self, '_session', session)
+        object.__setattr__(self, 'account', account)
+
+    def use_session(self, session: aiohttp.ClientSession) -> None:
+        object.__setattr__(self, '_session', session)
+
+    def _needs_session(self, name: str, method, args, kwargs) -> bool:
+        # wrappers such as RecordingClient forward the client's signature through __wrapped__
+        key = (self._exchange, type(self._client), name)
+        if key not in self._signatures:
+            try:
+                signature = inspect.signature(method)
+                self._signatures[key] = signature if 'session' in signature.parameters else None
+            except (TypeError, ValueError):
+                self._signatures[key] = None
+        if not (signature := self._signatures[key]):
+            return False
+        return 'session' not in signature.bind_partial(*args, **kwargs).arguments
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if name in BLOCKING:
+            async def offloaded(*args, **kwargs):
+                time_start = time.perf_counter()
+                try:
+                    return await asyncio.get_event_loop().run_in_executor(None, lambda: value(*args, **kwargs))
+                finally:
+                    timings.add(self.account, self._exchange, name, time.perf_counter() - time_start)
+            return offloaded
+        if inspect.iscoroutinefunction(value):
+            async def timed(*args, **kwargs):
+                if self._session and self._needs_session(name, value, args, kwargs):
+                    kwargs['session'] = self._session
+                time_start = time.perf_counter()
+                try:
+                    return await value(*args, **kwargs)
+                finally:
+                    timings.add(self.account, self._exchange, name, time.perf_counter() - time_start)
+            return timed
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
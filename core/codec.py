@@ -0,0 +1,146 @@
+import re
+import struct
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import msgpack
+import orjson
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+
+EXT_UUID = 1
+EXT_DATETIME = 2
+EXT_DATETIME_UTC = 3
+_MICROSECONDS = struct.Struct('<q')
+_EPOCH = datetime(1970, 1, 1)
+# whole strings are one token, so brackets and commas inside them are skipped by the regex engine
+_JSON_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{},]')
+# below this a JSON list is parsed at once, orjson is far faster than splitting it and the list is small
+LAZY_JSON_MIN_BYTES = 16 * 1024 * 1024
+
+# routing key -> {schema version: positional field layout}. Never edit a published
+# version, append a new one instead so consumers can still decode older messages.
+SCHEMAS = {
+    'logger.event.insert_orders': {
+        1: ('id', 'datetime', 'ts', 'context', 'parent_id', 'exchange_order_id', 'type', 'status', 'exchange_name',
+            'side', 'symbol', 'expect_price', 'expect_amount_coin', 'expect_amount_usd', 'expect_fee',
+            'factual_price', 'factual_amount_coin', 'factual_amount_usd', 'factual_fee', 'order_place_time', 'env',
+            'oneway_ping_orderbook', 'oneway_ping_order', 'inner_ping')},
+    'logger.event.insert_disbalances': {
+        1: ('id', 'datetime', 'ts', 'coin_name', 'position_coin', 'position_usd', 'price', 'threshold', 'status')},
+    'logger.event.insert_balances': {
+        1: ('id', 'datetime', 'ts', 'context', 'parent_id', 'exchange', 'exchange_balance', 'available_for_buy',
+            'available_for_sell', 'env', 'chat_id', 'bot_token', 'current_margin')},
+    'logger.event.insert_balance_detalization': {
+        1: ('id', 'datetime', 'ts', 'context', 'parent_id', 'exchange', 'symbol', 'current_margin', 'position_coin',
+            'position_usd', 'entry_price', 'mark_price', 'grand_parent_id', 'available_for_buy',
+            'available_for_sell')},
+    'logger.event.insert_funding': {
+        1: ('id', 'datetime', 'ts', 'exchange_funding_id', 'exchange', 'symbol', 'amount', 'asset', 'position',
+            'price')},
+    'logger.event.send_to_telegram': {
+        1: ('chat_id', 'msg', 'bot_token')},
+    'logger.event.check_balance': {
+        1: ('parent_id', 'context', 'env', 'chat_id', 'telegram_bot')},
+}
+
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    if isinstance(obj, datetime):
+        if obj.tzinfo:
+            delta = obj.astimezone(timezone.utc).replace(tzinfo=None) - _EPOCH
+            return msgpack.ExtType(EXT_DATETIME_UTC, _MICROSECONDS.pack(delta // timedelta(microseconds=1)))
+        return msgpack.ExtType(EXT_DATETIME, _MICROSECONDS.pack((obj - _EPOCH) // timedelta(microseconds=1)))
+    raise TypeError(f'Can not pack {type(obj)}')
+
+
+def _ext_hook(code: int, data: bytes):
+    """Decode to the same strings orjson writes, so both formats give equal payloads"""
+    if code == EXT_UUID:
+        return str(uuid.UUID(bytes=data))
+    if code == EXT_DATETIME:
+        return (_EPOCH + timedelta(microseconds=_MICROSECONDS.unpack(data)[0])).isoformat()
+    if code == EXT_DATETIME_UTC:
+        moment = _EPOCH + timedelta(microseconds=_MICROSECONDS.unpack(data)[0])
+        return moment.replace(tzinfo=timezone.utc).isoformat()
+    return msgpack.ExtType(code, data)
+
+
+def encode(message, routing_key: str, binary: bool = False) -> tuple:
+    """
+    :return: (body, content_type, headers)
+    """
+    if not binary:
+        return orjson.dumps(message), JSON, {}
+    versions = SCHEMAS.get(routing_key)
+    if versions and isinstance(message, dict):
+        version = max(versions)
+        fields = versions[version]
+        if len(message) == len(fields) and all(field in message for field in fields):
+            body = msgpack.packb([message[field] for field in fields], default=_default)
+            return body, MSGPACK, {'schema_version': version}
+    return msgpack.packb(message, default=_default), MSGPACK, {'schema_version': 0}
+
+
+def decode(body: bytes, content_type: str = None, headers: dict = None, routing_key: str = None):
+    if content_type != MSGPACK:
+        return orjson.loads(body)
+    payload = msgpack.unpackb(body, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+    version = (headers or {}).get('schema_version', 0)
+    if version:
+        return dict(zip(SCHEMAS[routing_key][version], payload))
+    return payload
+
+
+def _json_items(body: bytes):
+    """Top level JSON array elements one by one, only the current element is parsed"""
+    depth = 0
+    start = None
+    for match in _JSON_TOKENS.finditer(body):
+        token = match.group()
+        if token[:1] == b'"':
+            continue
+        if token in b'[{':
+            depth += 1
+            if depth == 1:
+                start = match.end()
+        elif token in b']}':
+            depth -= 1
+            if depth == 0:
+                if body[start:match.start()].strip():
+                    yield orjson.loads(body[start:match.start()])
+                return
+        elif depth == 1:
+            yield orjson.loads(body[start:match.start()])
+            start = match.end()
+
+
+def iter_items(body: bytes, content_type: str = None, headers: dict = None, routing_key: str = None):
+    """
+    Lazy decode of a list payload: yields its elements without building the whole list.
+    Anything that is not a list is yielded as a single item. JSON lists shorter than
+    LAZY_JSON_MIN_BYTES are parsed whole, lazy splitting only pays off for huge bodies.
+    """
+    if content_type != MSGPACK:
+        if body.lstrip()[:1] != b'[':
+            yield orjson.loads(body)
+        elif len(body) < LAZY_JSON_MIN_BYTES:
+            yield from orjson.loads(body)
+        else:
+            yield from _json_items(body)
+        return
+    if (headers or {}).get('schema_version', 0):
+        yield decode(body, content_type, headers, routing_key)
+        return
+    unpacker = msgpack.Unpacker(ext_hook=_ext_hook, raw=False, strict_map_key=False)
+    unpacker.feed(body)
+    try:
+        length = unpacker.read_array_header()
+    except msgpack.UnpackValueError:
+        yield decode(body, content_type, headers, routing_key)
+        return
+    for _ in range(length):
+        yield unpacker.unpack()
@@ -0,0 +1,65 @@
+def venue_state(client) -> dict:
+    """Positions, balances and leverage of a client as plain data, what margin and positions are built from"""
+    return {'positions': client.get_positions() or {},
+            'balance': client.get_balance() or 0,
+            'available': client.get_available_balance() or {},
+            'leverage': client.leverage}
+
+
+class ExchangeMargin:
+    __slots__ = 'balance', 'leverage', 'used', 'available'
+
+    def __init__(self, balance: float, leverage: float, used: float, available: dict):
+        self.balance = balance
+        self.leverage = leverage
+        self.used = used
+        self.available = available
+
+
+class MarginModel:
+    """
+    Per-exchange balance, leverage, used margin and available buy/sell capacity.
+    Refreshed from venue state once per cycle and updated in memory as orders are placed and
+    filled, so venue checks do not query clients again.
+    """
+    __slots__ = 'exchanges'
+
+    def __init__(self):
+        self.exchanges = {}
+
+    def refresh(self, venues: dict) -> None:
+        """
+        :param venues: {exchange: venue_state(client)}
+        """
+        for exchange, venue in venues.items():
+            self.load(exchange, venue)
+
+    def load(self, exchange: str, venue: dict) -> None:
+        used = sum([abs(x.get('amount_usd', 0)) for x in venue['positions'].values()])
+        available = dict(venue['available'])
+        for key, value in available.items():
+            if isinstance(value, dict):
+                available[key] = dict(value)
+        self.exchanges[exchange] = ExchangeMargin(venue['balance'], venue['leverage'], used, available)
+
+    def get(self, exchange: str):
+        return self.exchanges.get(exchange)
+
+    def available(self, exchange: str, symbol: str, side: str) -> float:
+        """Capacity in USD for a side, per-symbol value preferred over the exchange-wide one"""
+        if not (margin := self.exchanges.get(exchange)):
+            return 0
+        value = margin.available.get(symbol, {}).get(side)
+        if not value:
+            value = margin.available.get(side, 0)
+        return value
+
+    def apply_order(self, exchange: str, symbol: str, side: str, amount_usd: float) -> None:
+        """Buying takes buy capacity and frees the same amount for selling, and vice versa"""
+        if not (margin := self.exchanges.get(exchange)):
+            return
+        opposite = 'sell' if side == 'buy' else 'buy'
+        for scope in (margin.available.get(symbol), margin.available):
+            if isinstance(scope, dict) and scope.get(side) is not None:
+                scope[side] = scope[side] - amount_usd
+                scope[opposite] = scope.get(opposite, 0) + amount_usd
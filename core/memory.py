@@ -0,0 +1,74 @@
+import asyncio
+import gc
+import os
+import time
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def rss_bytes() -> int:
+    """Current resident set size from /proc/self/statm, 0 where procfs is not available"""
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class MemoryGuard:
+    """
+    RSS watermarks for a consumer: above high it should stop taking messages,
+    wait_low() collects garbage and returns once RSS is back under low or max_pause seconds passed.
+    """
+    __slots__ = 'high', 'low', 'poll_interval', 'max_pause'
+
+    def __init__(self, high_mb: float, low_mb: float = None, poll_interval: float = 1, max_pause: float = 300):
+        self.high = int(high_mb * 1024 * 1024)
+        self.low = int((low_mb if low_mb is not None else high_mb * 0.8) * 1024 * 1024)
+        self.poll_interval = poll_interval
+        self.max_pause = max_pause
+
+    def exceeded(self) -> bool:
+        return self.high > 0 and rss_bytes() > self.high
+
+    async def wait_low(self) -> bool:
+        """:return: True once RSS is under low, False if it is still above it after max_pause"""
+        deadline = time.monotonic() + self.max_pause
+        while True:
+            gc.collect()
+            if rss_bytes() <= self.low:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+
+
+class HandlerPool:
+    """
+    Reusable task handlers per routing key. A handler is taken for one message and given back
+    after it, messages processed concurrently get separate instances, at most max_idle are kept.
+    :param factories: {routing_key: callable () -> handler}
+    """
+    __slots__ = 'factories', 'max_idle', 'idle', 'created'
+
+    def __init__(self, factories: dict, max_idle: int = 4):
+        self.factories = factories
+        self.max_idle = max_idle
+        self.idle = {}
+        self.created = 0
+
+    def acquire(self, routing_key: str):
+        if idle := self.idle.get(routing_key):
+            return idle.pop()
+        self.created += 1
+        return self.factories[routing_key]()
+
+    def release(self, routing_key: str, handler) -> None:
+        if reset := getattr(handler, 'reset', None):
+            reset()
+        idle = self.idle.setdefault(routing_key, [])
+        if len(idle) < self.max_idle:
+            idle.append(handler)
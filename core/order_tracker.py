@@ -0,0 +1,130 @@
+import asyncio
+import time
+import traceback
+
+from core.rate_limiter import limiter, MARKET, ORDERS, HEDGE
+
+FILLED = 'Fully_Executed'
+NOT_EXECUTED = 'Not_Executed'
+
+
+class TrackedOrder:
+    __slots__ = 'client', 'coin', 'symbol', 'side', 'order_id', 'client_id', 'size', 'attempt', 'placed', 'price', \
+                'parent_id'
+
+    def __init__(self, client, coin: str, symbol: str, side: str, order_id: str, client_id: str, size: float,
+                 attempt: int = 0, price: float = 0, parent_id=None):
+        self.client = client
+        self.coin = coin
+        self.symbol = symbol
+        self.side = side
+        self.order_id = order_id
+        self.client_id = client_id
+        self.size = size
+        self.attempt = attempt
+        self.placed = time.time()
+        self.price = price
+        # disbalance the order was placed for, re-priced orders are reported under it too
+        self.parent_id = parent_id
+
+
+class OrderTracker:
+    """
+    Watches balancing orders until they fill or their deadline passes, one task per order.
+    Clients are AsyncClient adapters, so polling and cancels do not block the loop.
+    Unfilled remainders are cancelled and handed to reprice, results go straight to publish.
+    Clients without cancel_order keep expired orders open for the balancing cycle's targeted cancel.
+    :param publish: async (result: dict) -> None, sends UPDATE_ORDERS event
+    :param reprice: async (order: TrackedOrder, remaining: float) -> TrackedOrder or None
+    :param on_fill: optional (order: TrackedOrder, result: dict) -> None
+    :param on_close: optional (order: TrackedOrder, result: dict or None) -> None, the order is filled or
+        cancelled, result is its final state; called before the remainder is re-priced
+    """
+    __slots__ = 'publish', 'reprice', 'on_fill', 'on_close', 'poll_interval', 'deadline', 'max_reprices', 'tasks', \
+                'orders', 'coins'
+
+    def __init__(self, publish, reprice, on_fill=None, on_close=None, poll_interval: float = 1,
+                 deadline: float = 10, max_reprices: int = 2):
+        self.publish = publish
+        self.reprice = reprice
+        self.on_fill = on_fill
+        self.on_close = on_close
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.max_reprices = max_reprices
+        self.tasks = set()
+        self.orders = set()
+        self.coins = {}
+
+    def track(self, order: TrackedOrder) -> None:
+        self.orders.add((order.client.EXCHANGE_NAME, order.order_id))
+        self.coins[order.coin] = self.coins.get(order.coin, 0) + 1
+        task = asyncio.get_event_loop().create_task(self._watch(order))
+        self.tasks.add(task)
+        task.add_done_callback(lambda done: self._untrack(done, order))
+
+    def _untrack(self, task: asyncio.Task, order: TrackedOrder) -> None:
+        self.tasks.discard(task)
+        self.orders.discard((order.client.EXCHANGE_NAME, order.order_id))
+        if self.coins.get(order.coin, 0) > 1:
+            self.coins[order.coin] -= 1
+        else:
+            self.coins.pop(order.coin, None)
+
+    @property
+    def active(self) -> int:
+        return len(self.tasks)
+
+    def busy(self, coin: str) -> bool:
+        """A hedge for coin is still being watched or re-priced"""
+        return coin in self.coins
+
+    def is_tracked(self, exchange: str, order_id) -> bool:
+        return (exchange, order_id) in self.orders
+
+    def venue_busy(self, exchange: str) -> bool:
+        """An order on exchange is watched, or being cancelled and re-priced"""
+        return any(order_exchange == exchange for order_exchange, _ in self.orders)
+
+    async def _watch(self, order: TrackedOrder) -> None:
+        try:
+            result = None
+            while time.time() - order.placed < self.deadline:
+                await asyncio.sleep(self.poll_interval)
+                await limiter.acquire(order.client.EXCHANGE_NAME, MARKET, HEDGE)
+                result = await order.client.get_order_by_id(order.symbol, order.order_id)
+                if result and result.get('status') == FILLED:
+                    self._close(order, result)
+                    await self._done(order, result)
+                    return
+            if not hasattr(order.client, 'cancel_order'):
+                print(f"ORDER {order.client_id} {order.symbol} EXPIRED, LEFT TO CYCLE CANCEL")
+                if result:
+                    await self._done(order, result)
+                return
+            await limiter.acquire(order.client.EXCHANGE_NAME, ORDERS, HEDGE, account=order.client.account)
+            await order.client.cancel_order(order.symbol, order.order_id)
+            await limiter.acquire(order.client.EXCHANGE_NAME, MARKET, HEDGE)
+            result = await order.client.get_order_by_id(order.symbol, order.order_id) or result
+            self._close(order, result)
+            if result:
+                await self._done(order, result)
+                if result.get('status') == FILLED:
+                    return
+            filled = result.get('factual_amount_coin', 0) if result else 0
+            remaining = order.size - abs(filled or 0)
+            if order.attempt < self.max_reprices and remaining > 0:
+                if new_order := await self.reprice(order, remaining):
+                    self.track(new_order)
+        except Exception:
+            traceback.print_exc()
+
+    async def _done(self, order: TrackedOrder, result: dict) -> None:
+        print(f"ORDER {order.client_id} {order.symbol} {result.get('status')}")
+        await self.publish(result)
+        if self.on_fill and result.get('factual_amount_coin'):
+            self.on_fill(order, result)
+
+    def _close(self, order: TrackedOrder, result) -> None:
+        if self.on_close:
+            self.on_close(order, result)
@@ -0,0 +1,241 @@
+import asyncio
+import time
+import traceback
+from array import array
+
+import aiohttp
+import orjson
+import websockets
+
+
+class SequenceGap(Exception):
+    pass
+
+
+class Book:
+    """
+    Price levels of one symbol. Levels live in dicts while updates stream in and are
+    materialized into preallocated top-of-depth arrays only when a reader asks after a change.
+    """
+    __slots__ = 'depth', 'bids', 'asks', 'bid_prices', 'bid_sizes', 'ask_prices', 'ask_sizes', \
+                'n_bids', 'n_asks', 'seq', 'ts', 'dirty', 'synced'
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.bid_prices = array('d', bytes(8 * depth))
+        self.bid_sizes = array('d', bytes(8 * depth))
+        self.ask_prices = array('d', bytes(8 * depth))
+        self.ask_sizes = array('d', bytes(8 * depth))
+        self.reset()
+
+    def reset(self) -> None:
+        self.bids = {}
+        self.asks = {}
+        self.n_bids = 0
+        self.n_asks = 0
+        self.seq = None
+        self.ts = 0
+        self.dirty = False
+        self.synced = False
+
+    def update(self, side: dict, price: float, size: float) -> None:
+        if size:
+            side[price] = size
+        else:
+            side.pop(price, None)
+        self.dirty = True
+
+    def materialize(self) -> None:
+        if not self.dirty:
+            return
+        self.n_bids = self._fill(sorted(self.bids, reverse=True), self.bids, self.bid_prices, self.bid_sizes)
+        self.n_asks = self._fill(sorted(self.asks), self.asks, self.ask_prices, self.ask_sizes)
+        self.dirty = False
+
+    def _fill(self, prices: list, levels: dict, price_array: array, size_array: array) -> int:
+        count = min(len(prices), self.depth)
+        for i in range(count):
+            price_array[i] = prices[i]
+            size_array[i] = levels[prices[i]]
+        return count
+
+
+class BinanceFeed:
+    """Binance USDⓈ-M diff depth stream, gap when an event's pu is not the previous u"""
+    ws_url = 'wss://fstream.binance.com/ws/'
+    rest_url = 'https://fapi.binance.com/fapi/v1/depth'
+
+    async def run(self, symbol: str, book: Book, session: aiohttp.ClientSession) -> None:
+        async with websockets.connect(f"{self.ws_url}{symbol.lower()}@depth@100ms", max_size=None) as ws:
+            buffered = []
+            snapshot_task = asyncio.ensure_future(self._snapshot(symbol, session))
+            last_update_id = None
+            async for raw in ws:
+                event = orjson.loads(raw)
+                if last_update_id is None:
+                    buffered.append(event)
+                    if not snapshot_task.done():
+                        continue
+                    last_update_id = self._load(book, snapshot_task.result())
+                    events, buffered = buffered, []
+                else:
+                    events = [event]
+                for event in events:
+                    if event['u'] < last_update_id:
+                        continue
+                    if book.seq is None:
+                        if event['U'] > last_update_id:
+                            raise SequenceGap(f'{symbol} snapshot {last_update_id} older than {event["U"]}')
+                    elif event['pu'] != book.seq:
+                        raise SequenceGap(f'{symbol} {book.seq} -> {event["pu"]}')
+                    for price, size in event['b']:
+                        book.update(book.bids, float(price), float(size))
+                    for price, size in event['a']:
+                        book.update(book.asks, float(price), float(size))
+                    book.seq = event['u']
+                    book.ts = time.time()
+                    book.synced = True
+
+    async def _snapshot(self, symbol: str, session: aiohttp.ClientSession) -> dict:
+        await asyncio.sleep(0.5)
+        async with session.get(self.rest_url, params={'symbol': symbol, 'limit': 1000}) as resp:
+            return await resp.json(loads=orjson.loads)
+
+    @staticmethod
+    def _load(book: Book, snapshot: dict) -> int:
+        for price, size in snapshot['bids']:
+            book.update(book.bids, float(price), float(size))
+        for price, size in snapshot['asks']:
+            book.update(book.asks, float(price), float(size))
+        return snapshot['lastUpdateId']
+
+
+class ApolloxFeed(BinanceFeed):
+    ws_url = 'wss://fstream.apollox.finance/ws/'
+    rest_url = 'https://fapi.apollox.finance/fapi/v1/depth'
+
+
+class KrakenFeed:
+    """Kraken Futures book feed, gap when seq does not follow the previous one"""
+    ws_url = 'wss://futures.kraken.com/ws/v1'
+
+    async def run(self, symbol: str, book: Book, session: aiohttp.ClientSession) -> None:
+        async with websockets.connect(self.ws_url, max_size=None) as ws:
+            await ws.send(orjson.dumps({'event': 'subscribe', 'feed': 'book', 'product_ids': [symbol]}).decode())
+            async for raw in ws:
+                message = orjson.loads(raw)
+                feed = message.get('feed')
+                if feed == 'book_snapshot':
+                    book.reset()
+                    for level in message['bids']:
+                        book.update(book.bids, float(level['price']), float(level['qty']))
+                    for level in message['asks']:
+                        book.update(book.asks, float(level['price']), float(level['qty']))
+                elif feed == 'book' and book.seq is not None:
+                    if message['seq'] != book.seq + 1:
+                        raise SequenceGap(f'{symbol} {book.seq} -> {message["seq"]}')
+                    side = book.bids if message['side'] == 'buy' else book.asks
+                    book.update(side, float(message['price']), float(message['qty']))
+                else:
+                    continue
+                book.seq = message['seq']
+                book.ts = time.time()
+                book.synced = True
+
+
+FEEDS = {
+    'BINANCE': BinanceFeed,
+    'APOLLOX': ApolloxFeed,
+    'KRAKEN': KrakenFeed,
+}
+
+
+class OrderbookStore:
+    """
+    Push-fed orderbooks for symbols the balancer cares about, one websocket task per symbol.
+    Readers get top of book or memoryviews over the depth arrays, without copying.
+    Books older than max_age read as missing, so callers fall back to REST. REST tops callers
+    remember are served to everyone sharing the store for snapshot_max_age.
+    Balancers sharing the store declare what they need with follow(), a symbol is dropped once nobody does.
+    """
+    __slots__ = 'session', 'depth', 'max_age', 'snapshot_max_age', 'books', 'snapshots', 'tasks', 'feeds', 'wanted'
+
+    def __init__(self, session: aiohttp.ClientSession, depth: int = 20, max_age: float = 2,
+                 snapshot_max_age: float = 0.5):
+        self.session = session
+        self.depth = depth
+        self.max_age = max_age
+        self.snapshot_max_age = snapshot_max_age
+        self.books = {}
+        self.snapshots = {}
+        self.tasks = {}
+        self.feeds = {exchange: feed() for exchange, feed in FEEDS.items()}
+        self.wanted = {}
+
+    def track(self, exchange: str, symbol: str) -> None:
+        if (exchange, symbol) in self.tasks or exchange not in self.feeds:
+            return
+        book = self.books[(exchange, symbol)] = Book(self.depth)
+        self.tasks[(exchange, symbol)] = asyncio.ensure_future(self._keep(exchange, symbol, book))
+
+    def untrack(self, exchange: str, symbol: str) -> None:
+        if task := self.tasks.pop((exchange, symbol), None):
+            task.cancel()
+        self.books.pop((exchange, symbol), None)
+        self.snapshots.pop((exchange, symbol), None)
+
+    def follow(self, owner: str, wanted: set) -> None:
+        """
+        :param owner: name of the balancer, accounts sharing the store keep separate sets
+        :param wanted: {(exchange, symbol)} the owner needs now, replaces its previous set
+        """
+        self.wanted[owner] = wanted
+        needed = set().union(*self.wanted.values())
+        for exchange, symbol in needed:
+            self.track(exchange, symbol)
+        for exchange, symbol in set(self.tasks) - needed:
+            self.untrack(exchange, symbol)
+
+    async def _keep(self, exchange: str, symbol: str, book: Book) -> None:
+        while True:
+            try:
+                await self.feeds[exchange].run(symbol, book, self.session)
+            except asyncio.CancelledError:
+                raise
+            except SequenceGap as e:
+                print(f"ORDERBOOK RESYNC {exchange} {e}")
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+            book.reset()
+
+    def _fresh(self, exchange: str, symbol: str):
+        book = self.books.get((exchange, symbol))
+        if not book or not book.synced or time.time() - book.ts > self.max_age:
+            return None
+        book.materialize()
+        if not book.n_bids or not book.n_asks:
+            return None
+        return book
+
+    def top(self, exchange: str, symbol: str):
+        """:return: (bid, ask) or None"""
+        if book := self._fresh(exchange, symbol):
+            return book.bid_prices[0], book.ask_prices[0]
+        if snapshot := self.snapshots.get((exchange, symbol)):
+            if time.time() - snapshot[2] <= self.snapshot_max_age:
+                return snapshot[0], snapshot[1]
+
+    def remember(self, exchange: str, symbol: str, bid: float, ask: float) -> None:
+        self.snapshots[(exchange, symbol)] = (bid, ask, time.time())
+
+    def depth_arrays(self, exchange: str, symbol: str):
+        """:return: (bid_prices, bid_sizes, ask_prices, ask_sizes) memoryviews or None"""
+        if book := self._fresh(exchange, symbol):
+            return (memoryview(book.bid_prices)[:book.n_bids], memoryview(book.bid_sizes)[:book.n_bids],
+                    memoryview(book.ask_prices)[:book.n_asks], memoryview(book.ask_sizes)[:book.n_asks])
+
+    def close(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
@@ -0,0 +1,88 @@
+import asyncio
+import sqlite3
+import time
+import traceback
+
+import orjson
+
+
+class Outbox:
+    """
+    Durable queue of broker messages in SQLite (WAL). put() is a single local insert, a background
+    drainer publishes batches and deletes rows only after the broker confirmed them, so records
+    written before a crash are published on the next start. Keys are unique: writing the same
+    record twice is a no-op, and the key travels as message_id for consumers to deduplicate.
+    """
+    __slots__ = 'path', 'db', 'batch', 'interval', 'max_backoff', 'wakeup'
+
+    def __init__(self, path: str, batch: int = 100, interval: float = 1, max_backoff: float = 60):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.wakeup = None
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox (key TEXT PRIMARY KEY, routing_key TEXT, '
+                        'exchange_name TEXT, queue_name TEXT, body BLOB, content_type TEXT, headers BLOB, '
+                        'created REAL)')
+
+    def put(self, key: str, routing_key: str, exchange_name: str, queue_name: str, body: bytes,
+            content_type: str, headers: dict) -> None:
+        self.db.execute('INSERT OR IGNORE INTO outbox VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, routing_key, exchange_name, queue_name, body, content_type, orjson.dumps(headers),
+                         time.time()))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def pending(self) -> list:
+        rows = self.db.execute('SELECT key, routing_key, exchange_name, queue_name, body, content_type, headers '
+                               'FROM outbox ORDER BY rowid LIMIT ?', (self.batch,)).fetchall()
+        return [(*row[:6], orjson.loads(row[6])) for row in rows]
+
+    def ack(self, keys: list) -> None:
+        self.db.executemany('DELETE FROM outbox WHERE key = ?', [(key,) for key in keys])
+
+    def size(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    async def drain(self, publish_batch, alert=None) -> None:
+        """
+        :param publish_batch: async (rows) -> list of keys the broker confirmed, raises while it is unreachable
+        :param alert: (text) -> None, called once when publishing starts failing and once when it recovers
+        Failed batches are retried with exponential backoff up to max_backoff.
+        """
+        self.wakeup = asyncio.Event()
+        failures = 0
+        while True:
+            rows = self.pending()
+            if not rows:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                acked = await publish_batch(rows)
+            except Exception as error:
+                failures += 1
+                delay = min(self.interval * 2 ** failures, self.max_backoff)
+                if failures == 1:
+                    traceback.print_exc()
+                    if alert:
+                        alert(f"OUTBOX {self.path}: PUBLISH FAILED ({error!r}), RETRYING, {self.size()} PENDING")
+                else:
+                    print(f"OUTBOX {self.path}: PUBLISH FAILED {failures} TIMES, RETRY IN {delay} S")
+                await asyncio.sleep(delay)
+                continue
+            if failures:
+                print(f"OUTBOX {self.path}: PUBLISHING AGAIN AFTER {failures} FAILED ATTEMPTS")
+                if alert:
+                    alert(f"OUTBOX {self.path}: PUBLISHING AGAIN, {self.size()} PENDING")
+                failures = 0
+            if acked:
+                self.ack(acked)
+            if not acked or len(acked) < len(rows):
+                await asyncio.sleep(self.interval)
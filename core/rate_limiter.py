@@ -0,0 +1,206 @@
+import asyncio
+import fcntl
+import heapq
+import itertools
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+ORDERS = 'orders'
+MARKET = 'market'
+
+HEDGE = 0
+BALANCING = 1
+REPORTING = 2
+
+# budget -> (capacity, refill per second) for exchanges without [RATE_LIMITS], requests of weight 1
+DEFAULT_LIMITS = {
+    ORDERS: (10, 5),
+    MARKET: (20, 10),
+}
+# share of the bucket a priority has to leave untouched, so lower lanes can not starve hedges
+# in other processes sharing the same bucket
+HEADROOM = {
+    HEDGE: 0,
+    BALANCING: 0.2,
+    REPORTING: 0.5,
+}
+USED_WEIGHT_HEADERS = {
+    'x-mbx-used-weight-1m': 2400,
+}
+# API hosts whose responses carry USED_WEIGHT_HEADERS
+EXCHANGE_HOSTS = {
+    'fapi.binance.com': 'BINANCE',
+    'fapi.apollox.finance': 'APOLLOX',
+}
+# tokens, updated, rate, blocked_until
+SHARED_STATE = struct.Struct('<dddd')
+
+
+class TokenBucket:
+    """
+    Token bucket with priority lanes. Inside a process the lowest priority value is served first; across
+    processes sharing the bucket file, every lane but HEDGE has to leave its HEADROOM share untouched,
+    so hedge orders get tokens while reporting traffic waits. Refill rate drops on 429 and recovers slowly.
+    With a path the state (tokens, rate, block) lives in that file and every change is made under flock.
+    """
+    __slots__ = 'capacity', 'rate', 'base_rate', 'tokens', 'updated', 'blocked_until', 'waiters', 'counter', \
+              'used', 'waited', 'throttled', 'fd'
+
+    def __init__(self, capacity: float, rate: float, path: str = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.base_rate = rate
+        self.tokens = capacity
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.used = 0
+        self.waited = 0
+        self.throttled = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644) if path else None
+
+    @contextmanager
+    def _shared(self):
+        if self.fd is None:
+            yield
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if len(data := os.pread(self.fd, SHARED_STATE.size, 0)) == SHARED_STATE.size:
+                self.tokens, self.updated, self.rate, self.blocked_until = SHARED_STATE.unpack(data)
+            yield
+            os.pwrite(self.fd, SHARED_STATE.pack(self.tokens, self.updated, self.rate, self.blocked_until), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate * (1 + 0.01 * elapsed))
+
+    async def acquire(self, priority: int = BALANCING, weight: float = 1) -> None:
+        entry = (priority, next(self.counter))
+        heapq.heappush(self.waiters, entry)
+        headroom = self.capacity * HEADROOM.get(priority, 0)
+        time_start = time.time()
+        try:
+            while True:
+                with self._shared():
+                    now = time.time()
+                    self._refill(now)
+                    if self.waiters[0] == entry and now >= self.blocked_until and \
+                            self.tokens - weight >= headroom:
+                        self.tokens -= weight
+                        self.used += weight
+                        self.waited += now - time_start
+                        return
+                    if now < self.blocked_until:
+                        wait = self.blocked_until - now
+                    else:
+                        wait = max((weight + headroom - self.tokens) / self.rate, 0.005)
+                await asyncio.sleep(wait)
+        finally:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    def penalize(self, retry_after: float = None) -> None:
+        """429 or ban: halve the refill rate and stop everything for retry_after (or a second)"""
+        self.throttled += 1
+        with self._shared():
+            self._refill(time.time())
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.time() + (retry_after or 1))
+
+    def observe_usage(self, used: float, limit: float) -> None:
+        """Exchange reported usage, drain tokens so we never run ahead of the venue's count"""
+        with self._shared():
+            self._refill(time.time())
+            self.tokens = min(self.tokens, self.capacity * max(0.0, 1 - used / limit))
+
+    def utilisation(self) -> float:
+        with self._shared():
+            self._refill(time.time())
+            return round(1 - self.tokens / self.capacity, 3)
+
+
+class RateLimiter:
+    """
+    Request budgets: order placement and market data are separate buckets, priority decides who
+    waits when a bucket runs low. Order budgets belong to an API key, so they are kept per
+    (account, exchange); market data weight is counted per host IP and stays per exchange.
+    With a directory every bucket is a small state file there, shared by all processes on the host
+    (balancer, shard workers, consumers) using the same directory.
+    """
+    __slots__ = 'limits', 'buckets', 'directory'
+
+    def __init__(self, limits: dict = None, directory: str = None):
+        self.limits = limits or {}
+        self.buckets = {}
+        self.directory = directory
+
+    def share(self, directory: str) -> None:
+        """Keep buckets created from now on in directory"""
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def bucket(self, exchange: str, budget: str, account: str = None) -> TokenBucket:
+        key = (account if budget == ORDERS else None, exchange, budget)
+        if not (bucket := self.buckets.get(key)):
+            capacity, rate = self.limits.get((exchange, budget)) or DEFAULT_LIMITS[budget]
+            name = f"{key[0]}_{exchange}_{budget}" if key[0] else f"{exchange}_{budget}"
+            path = os.path.join(self.directory, f"{name}.bucket") if self.directory else None
+            bucket = self.buckets[key] = TokenBucket(capacity, rate, path)
+        return bucket
+
+    async def acquire(self, exchange: str, budget: str, priority: int = BALANCING, weight: float = 1,
+                      account: str = None) -> None:
+        await self.bucket(exchange, budget, account).acquire(priority, weight)
+
+    def penalize(self, exchange: str, budget: str, retry_after: float = None, account: str = None) -> None:
+        self.bucket(exchange, budget, account).penalize(retry_after)
+
+    def observe_headers(self, exchange: str, budget: str, status: int, headers: dict) -> None:
+        """Responses do not tell which account sent them, they count for every bucket of the budget"""
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        buckets = [bucket for (_, bucket_exchange, bucket_budget), bucket in self.buckets.items()
+                   if bucket_exchange == exchange and bucket_budget == budget] or [self.bucket(exchange, budget)]
+        if status in (418, 429):
+            retry_after = headers.get('retry-after')
+            for bucket in buckets:
+                bucket.penalize(float(retry_after) if retry_after else None)
+        for header, limit in USED_WEIGHT_HEADERS.items():
+            if header in headers:
+                for bucket in buckets:
+                    bucket.observe_usage(float(headers[header]), limit)
+
+    def metrics(self, account: str = None) -> dict:
+        """Market buckets and the order buckets of account"""
+        return {f"{exchange}_{budget}": {'utilisation': bucket.utilisation(),
+                                         'used': bucket.used,
+                                         'waited_s': round(bucket.waited, 3),
+                                         'throttled': bucket.throttled,
+                                         'rate': round(bucket.rate, 3)}
+                for (bucket_account, exchange, budget), bucket in self.buckets.items()
+                if bucket_account in (None, account)}
+
+
+def limits_from_config(section) -> dict:
+    """
+    [RATE_LIMITS] section, keys <EXCHANGE>_<BUDGET> = capacity,refill_per_second
+    """
+    limits = {}
+    for key, value in (section or {}).items():
+        exchange, budget = key.upper().rsplit('_', 1)
+        capacity, rate = value.split(',')
+        limits[(exchange, budget.lower())] = (float(capacity), float(rate))
+    return limits
+
+
+limiter = RateLimiter()
@@ -0,0 +1,62 @@
+import asyncio
+import heapq
+import random
+import traceback
+from collections import defaultdict
+
+
+class PeriodicScheduler:
+    """
+    Single heap-based timer for periodic jobs. Every job runs at a fixed rate against its own
+    schedule (start + k * interval) so delays do not accumulate, and jobs that share an interval
+    get evenly spread phases plus random jitter instead of firing together. Each run is its own task,
+    so a slow callback does not hold the timer; a job whose previous run is still going is skipped.
+    :param jobs: dicts with 'interval' and optional 'delay', seconds
+    :param callback: async (job) -> None
+    :param jitter: fraction of the per-job phase slot used as random jitter
+    """
+    __slots__ = 'jobs', 'callback', 'jitter', 'heap', 'running'
+
+    def __init__(self, jobs: list, callback, jitter: float = 0.5):
+        self.jobs = jobs
+        self.callback = callback
+        self.jitter = jitter
+        self.heap = []
+        self.running = {}
+
+    def _schedule(self, now: float) -> None:
+        groups = defaultdict(list)
+        for index, job in enumerate(self.jobs):
+            groups[job['interval']].append(index)
+        for interval, indexes in groups.items():
+            slot = interval / len(indexes)
+            for position, index in enumerate(indexes):
+                first_run = now + (self.jobs[index].get('delay') or 0) + position * slot
+                first_run += random.uniform(0, self.jitter * slot)
+                heapq.heappush(self.heap, (first_run, index))
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        self._schedule(loop.time())
+        while self.heap:
+            next_run, index = self.heap[0]
+            if (wait := next_run - loop.time()) > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self.heap)
+            job = self.jobs[index]
+            if (running := self.running.get(index)) and not running.done():
+                print(f"SKIP {job.get('queue')}: PREVIOUS RUN STILL RUNNING")
+            else:
+                self.running[index] = loop.create_task(self._run(job))
+            interval = job['interval']
+            next_run += interval
+            if (now := loop.time()) > next_run:
+                next_run += ((now - next_run) // interval + 1) * interval
+            heapq.heappush(self.heap, (next_run, index))
+
+    async def _run(self, job: dict) -> None:
+        try:
+            await self.callback(job)
+        except Exception:
+            traceback.print_exc()
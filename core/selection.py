@@ -0,0 +1,44 @@
+TICKS_OVER_TOP = 5
+AVAILABLE_TOLERANCE = 0.99
+
+
+def select_exchange(venues: dict, size: float, side: str) -> tuple:
+    """
+    Pick venue, price and size for a balancing order from a snapshot of venues.
+    Pure function of its input so recorded snapshots can be replayed offline.
+    :param venues: {exchange: {'min_size', 'tick_size', 'available', 'ask', 'bid'}}
+    :param size: absolute disbalance, coin
+    :param side: 'buy' or 'sell'
+    :return: (exchange, price, size) or (None, None, None)
+    """
+    exchanges = []
+    for ex, venue in venues.items():
+        if venue['min_size'] <= abs(size) and venue['available'] and venue['available'] > 0:
+            change = venue['ask'] + venue['bid']
+            if venue['available'] >= size * change:
+                exchanges.append(ex)
+            elif venue['available'] >= size * change * AVAILABLE_TOLERANCE:
+                exchanges.append(ex)
+                size = size * AVAILABLE_TOLERANCE
+    if not len(exchanges):
+        for ex, venue in venues.items():
+            if venue['min_size'] <= abs(size) and venue['available'] and venue['available'] > 0:
+                size = venue['available'] / (venue['ask'] + venue['bid'])
+                exchanges.append(ex)
+    top_exchange = None
+    best_price = None
+    for ex in exchanges:
+        venue = venues[ex]
+        if side == 'buy':
+            pretend_price = venue['ask'] + TICKS_OVER_TOP * venue['tick_size']
+            if best_price is None or pretend_price < best_price:
+                top_exchange = ex
+                best_price = pretend_price
+        else:
+            pretend_price = venue['bid'] - TICKS_OVER_TOP * venue['tick_size']
+            if best_price is None or pretend_price > best_price:
+                top_exchange = ex
+                best_price = pretend_price
+    if top_exchange:
+        return top_exchange, best_price, size
+    return None, None, None
@@ -0,0 +1,51 @@
+import os
+import time
+import uuid
+
+import msgpack
+
+DECISION_FIELDS = ('ts', 'coin', 'side', 'exchange', 'price', 'size', 'latency_ms',
+                   'disbalance_coin', 'disbalance_usd', 'venues')
+
+
+class ShadowSink:
+    """
+    Simulated order sink for shadow balancing. Accepts orders instead of the exchange and
+    answers with the same result shape client.create_order does.
+    """
+    __slots__ = ()
+
+    async def create_order(self, client, symbol: str, side: str, price: float, size: float, client_id: str) -> dict:
+        timestamp = int(time.time() * 1000)
+        return {'exchange_name': client.EXCHANGE_NAME,
+                'exchange_order_id': f"shadow_{uuid.uuid4().hex[:20]}",
+                'client_id': client_id,
+                'timestamp': timestamp,
+                'status': 'Processing'}
+
+
+class DecisionLog:
+    """
+    Append-only msgpack log of balancing decisions. Every record is a positional array
+    laid out as DECISION_FIELDS; venues hold the snapshot selection was made from.
+    """
+    __slots__ = 'path', 'fd'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write(self, coin: str, side: str, exchange: str, price: float, size: float, latency_ms: float,
+              disbalance: dict, venues: dict) -> None:
+        record = [time.time(), coin, side, exchange, price, size, round(latency_ms, 3),
+                  disbalance['coin'], disbalance['usd'], venues]
+        os.write(self.fd, msgpack.packb(record))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def read_decisions(path: str):
+    with open(path, 'rb') as file:
+        for record in msgpack.Unpacker(file, raw=False):
+            yield dict(zip(DECISION_FIELDS, record))
@@ -0,0 +1,121 @@
+import fcntl
+import os
+import time
+import zlib
+from contextlib import contextmanager
+
+import orjson
+
+
+def shard_of(coin: str, shards: int) -> int:
+    return zlib.crc32(coin.encode()) % shards
+
+
+class ShardCoordinator:
+    """
+    Local coordinator for balancer workers on one host. State lives in a single file guarded by flock:
+    one lease per shard, worker heartbeats and capital reserved on exchanges by open orders.
+    A shard is balanced only by the worker holding its unexpired lease. Worker k prefers shard k,
+    orphaned shards are claimed by any worker once it has been up for a full ttl, and handed back
+    as soon as their own worker is alive again. The shard 0 holder also publishes venue state
+    (positions, balances) for the others, so venues are queried once per cycle, not once per worker.
+    """
+    __slots__ = 'worker', 'shards', 'ttl', 'started', 'leases', 'state_path', 'lock_path', 'venues_path'
+
+    def __init__(self, directory: str, worker: int, shards: int, ttl: float):
+        os.makedirs(directory, exist_ok=True)
+        self.worker = worker
+        self.shards = shards
+        self.ttl = ttl
+        self.started = time.time()
+        self.leases = {}
+        self.state_path = os.path.join(directory, 'shards.json')
+        self.lock_path = os.path.join(directory, 'shards.lock')
+        self.venues_path = os.path.join(directory, 'venues.json')
+
+    @contextmanager
+    def _state(self):
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self.state_path):
+                    with open(self.state_path, 'rb') as file:
+                        state = orjson.loads(file.read() or b'{}') or {}
+                now = time.time()
+                state['leases'] = {k: v for k, v in state.get('leases', {}).items() if v[1] > now}
+                state['workers'] = {k: v for k, v in state.get('workers', {}).items() if v > now}
+                state['reserved'] = {k: v for k, v in state.get('reserved', {}).items() if v[4] > now}
+                yield state
+                tmp_path = self.state_path + '.tmp'
+                with open(tmp_path, 'wb') as file:
+                    file.write(orjson.dumps(state))
+                os.replace(tmp_path, self.state_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def renew(self) -> set:
+        """Heartbeat, extend own leases and claim free ones. Returns the shards this worker holds"""
+        now = time.time()
+        expires = now + self.ttl
+        with self._state() as state:
+            leases = state['leases']
+            state['workers'][str(self.worker)] = expires
+            for shard in range(self.shards):
+                key = str(shard)
+                holder = leases.get(key, [None])[0]
+                if holder == self.worker:
+                    if shard != self.worker and key in state['workers']:
+                        del leases[key]
+                    else:
+                        leases[key] = [self.worker, expires]
+                elif holder is None:
+                    if shard == self.worker or (key not in state['workers'] and now - self.started > self.ttl):
+                        leases[key] = [self.worker, expires]
+            self.leases = {int(k): v[1] for k, v in leases.items() if v[0] == self.worker}
+        return set(self.leases)
+
+    def held(self, shard: int) -> bool:
+        """The shard lease is held by this worker and has not expired since the last renew"""
+        return self.leases.get(shard, 0) > time.time()
+
+    def owns(self, coin: str) -> bool:
+        return self.held(shard_of(coin, self.shards))
+
+    def holds(self, coin: str) -> bool:
+        """Same as owns, checked against the shared state, for right before an order goes out"""
+        with self._state() as state:
+            lease = state['leases'].get(str(shard_of(coin, self.shards)))
+            return bool(lease) and lease[0] == self.worker
+
+    def reserved(self, exchange: str, side: str) -> float:
+        """Capital other workers reserved on exchange side, USD"""
+        with self._state() as state:
+            return sum([r[3] for r in state['reserved'].values()
+                        if r[0] != self.worker and r[1] == exchange and r[2] == side])
+
+    def reserve(self, key: str, exchange: str, side: str, amount_usd: float) -> None:
+        """Reserve capital for an open order until release(key) or the ttl, whichever comes first"""
+        with self._state() as state:
+            state['reserved'][key] = [self.worker, exchange, side, amount_usd, time.time() + self.ttl]
+
+    def release(self, key: str) -> None:
+        with self._state() as state:
+            state['reserved'].pop(key, None)
+
+    def publish_venues(self, venues: dict) -> None:
+        tmp_path = self.venues_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(orjson.dumps({'ts': time.time(), 'venues': venues}))
+        os.replace(tmp_path, self.venues_path)
+
+    def venues(self, max_age: float):
+        """Venue state published by the shard 0 holder, None if missing or older than max_age"""
+        try:
+            with open(self.venues_path, 'rb') as file:
+                published = orjson.loads(file.read())
+        except (OSError, ValueError):
+            return None
+        if time.time() - published.get('ts', 0) > max_age:
+            return None
+        return published['venues']
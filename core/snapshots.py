@@ -0,0 +1,223 @@
+import functools
+import mmap
+import os
+import struct
+import time
+import uuid
+import zlib
+from collections import defaultdict
+
+import msgpack
+
+HEADER = struct.Struct('<dHI')
+RECORDED_SYNC = ('get_positions', 'get_balance', 'get_available_balance', 'get_orderbook', 'get_real_balance',
+                 'get_position', 'get_order_by_id')
+RECORDED_ASYNC = ('get_orderbook_by_symbol', 'get_funding_payments', 'get_all_orders')
+RECORDED_ATTRS = ('markets', 'instruments')
+# fetched exactly once per balancing cycle, running out of these frames is the end of the recording
+CYCLE_CALL = 'get_position'
+
+_recorders = {}
+_readers = {}
+
+
+def _call_key(args, kwargs) -> list:
+    """Only plain values identify a call, sessions and other objects are dropped"""
+    plain = (str, int, float, bool, type(None))
+    key = [a for a in args if isinstance(a, plain)]
+    key += [[k, v] for k, v in sorted(kwargs.items()) if isinstance(v, plain)]
+    return key
+
+
+class SnapshotRecorder:
+    """
+    Append-only log of client inputs. Every frame is a fixed header (timestamp, meta length,
+    value length), plain msgpack meta [exchange, name, call_key] and the zlib-compressed msgpack
+    value, so the file can be memory-mapped and indexed without decompressing any value.
+    """
+    __slots__ = 'path', 'fd', 'level'
+
+    def __init__(self, path: str, level: int = 1):
+        self.path = path
+        self.level = level
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write(self, exchange: str, name: str, key: list, value) -> None:
+        meta = msgpack.packb([exchange, name, key], default=str)
+        body = zlib.compress(msgpack.packb(value, default=str), self.level)
+        os.write(self.fd, HEADER.pack(time.time(), len(meta), len(body)) + meta + body)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def get_recorder(path: str) -> SnapshotRecorder:
+    if path not in _recorders:
+        _recorders[path] = SnapshotRecorder(path)
+    return _recorders[path]
+
+
+class RecordingClient:
+    """
+    Transparent proxy over an exchange client writing every input it hands out to a recorder
+    """
+    __slots__ = '_client', '_recorder', '_exchange'
+
+    def __init__(self, client, exchange: str, recorder: SnapshotRecorder):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_recorder', recorder)
+        object.__setattr__(self, '_exchange', exchange)
+        for attr in RECORDED_ATTRS:
+            recorder.write(exchange, attr, [], getattr(client, attr, {}))
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if name in RECORDED_SYNC:
+            @functools.wraps(value)
+            def recorded(*args, **kwargs):
+                result = value(*args, **kwargs)
+                self._recorder.write(self._exchange, name, _call_key(args, kwargs), result)
+                return result
+            return recorded
+        if name in RECORDED_ASYNC:
+            @functools.wraps(value)
+            async def recorded_async(*args, **kwargs):
+                result = await value(*args, **kwargs)
+                self._recorder.write(self._exchange, name, _call_key(args, kwargs), result)
+                return result
+            return recorded_async
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._client, name, value)
+
+
+class SnapshotReader:
+    """
+    Memory-mapped view of a snapshot log. Frames are indexed once on open by
+    (exchange, name, call key) and values are decompressed only when a replay client asks for them.
+    """
+    __slots__ = 'path', 'file', 'buffer', 'index'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = defaultdict(list)
+        offset = 0
+        while offset + HEADER.size <= len(self.buffer):
+            ts, meta_length, length = HEADER.unpack_from(self.buffer, offset)
+            offset += HEADER.size
+            exchange, name, key = msgpack.unpackb(self.buffer[offset:offset + meta_length], raw=False)
+            offset += meta_length
+            self.index[(exchange, name, msgpack.packb(key))].append((offset, length))
+            offset += length
+
+    def frames(self, exchange: str, name: str, key: list) -> list:
+        """(offset, length) of the recorded values for one call, in recorded order"""
+        return self.index.get((exchange, name, msgpack.packb(key)), [])
+
+    def read(self, offset: int, length: int):
+        return msgpack.unpackb(zlib.decompress(self.buffer[offset:offset + length]), raw=False,
+                               strict_map_key=False)
+
+    def close(self) -> None:
+        self.buffer.close()
+        self.file.close()
+
+
+def get_reader(path: str) -> SnapshotReader:
+    if path not in _readers:
+        _readers[path] = SnapshotReader(path)
+    return _readers[path]
+
+
+class ReplayClient:
+    """
+    Exchange client answering from a snapshot log. Calls with the same name and arguments return
+    recorded values in recorded order, the last value repeats once they run out. Orders go nowhere.
+    exhausted turns True when CYCLE_CALL is asked for more values than were recorded.
+    """
+    __slots__ = 'EXCHANGE_NAME', 'markets', 'instruments', 'orderbook', 'leverage', 'taker_fee', \
+                'LAST_ORDER_ID', 'error_info', 'exhausted', '_reader', '_cursor', '_last'
+
+    def __init__(self, exchange: str, reader: SnapshotReader, leverage: float = 1, taker_fee: float = 0):
+        self.EXCHANGE_NAME = exchange
+        self.markets = {}
+        self.instruments = {}
+        self.orderbook = {}
+        self.leverage = leverage
+        self.taker_fee = taker_fee
+        self.LAST_ORDER_ID = 'default'
+        self.error_info = None
+        self.exhausted = False
+        self._reader = reader
+        self._cursor = defaultdict(int)
+        self._last = {}
+        for attr in RECORDED_ATTRS:
+            if frames := reader.frames(exchange, attr, []):
+                setattr(self, attr, reader.read(*frames[0]))
+
+    def _next(self, name: str, args, kwargs):
+        key = _call_key(args, kwargs)
+        frames = self._reader.frames(self.EXCHANGE_NAME, name, key)
+        if not frames:
+            if name == CYCLE_CALL:
+                self.exhausted = True
+            return None
+        cursor_key = (name, msgpack.packb(key))
+        cursor = self._cursor[cursor_key]
+        self._cursor[cursor_key] = cursor + 1
+        if cursor >= len(frames):
+            # recorded values ran out, the last one repeats without decompressing it again
+            if name == CYCLE_CALL:
+                self.exhausted = True
+            return self._last[cursor_key]
+        value = self._reader.read(*frames[cursor])
+        self._last[cursor_key] = value
+        return value
+
+    def get_positions(self, *args, **kwargs):
+        return self._next('get_positions', args, kwargs) or {}
+
+    def get_balance(self, *args, **kwargs):
+        return self._next('get_balance', args, kwargs) or 0
+
+    def get_available_balance(self, *args, **kwargs):
+        return self._next('get_available_balance', args, kwargs) or {}
+
+    def get_orderbook(self, *args, **kwargs):
+        return self._next('get_orderbook', args, kwargs)
+
+    def get_real_balance(self, *args, **kwargs):
+        return self._next('get_real_balance', args, kwargs)
+
+    def get_position(self, *args, **kwargs):
+        return self._next('get_position', args, kwargs)
+
+    def get_order_by_id(self, *args, **kwargs):
+        return self._next('get_order_by_id', args, kwargs)
+
+    async def get_orderbook_by_symbol(self, *args, **kwargs):
+        return self._next('get_orderbook_by_symbol', args, kwargs)
+
+    async def get_funding_payments(self, *args, **kwargs):
+        return self._next('get_funding_payments', args, kwargs) or []
+
+    async def get_all_orders(self, *args, **kwargs):
+        return self._next('get_all_orders', args, kwargs) or []
+
+    def fit_sizes(self, price: float, size: float, symbol: str) -> tuple:
+        instrument = self.instruments.get(symbol, {})
+        if tick := instrument.get('tick_size'):
+            price = round(round(price / tick) * tick, 10)
+        if step := instrument.get('step_size'):
+            size = round(round(size / step) * step, 10)
+        return price, size
+
+    async def create_order(self, symbol: str, side: str, price: float, size: float, **kwargs) -> dict:
+        self.LAST_ORDER_ID = f"replay_{uuid.uuid4().hex[:20]}"
+        return {'exchange_name': self.EXCHANGE_NAME, 'timestamp': int(time.time() * 1000), 'status': 'Processing'}
+
+    def cancel_all_orders(self, *args, **kwargs) -> None:
+        return None
@@ -0,0 +1,115 @@
+import re
+from typing import NamedTuple
+
+PERPETUAL = 'perpetual'
+INVERSE_PERPETUAL = 'inverse_perpetual'
+FUTURE = 'future'
+
+# exchange asset codes -> the coin names used in markets and reports
+ALIASES = {'XBT': 'BTC', 'XDG': 'DOGE'}
+
+_QUOTES = 'USDT|USDC|BUSD|USD|EUR|GBP'
+_LINEAR = re.compile(rf'^(?P<base>[A-Z0-9]+?)(?P<quote>{_QUOTES})(?:_(?P<expiry>\d+))?$')
+_DASHED = re.compile(rf'^(?P<base>[A-Z0-9]+)-(?P<quote>{_QUOTES})(?:-(?P<expiry>\w+))?$')
+_KRAKEN = re.compile(rf'^(?P<kind>PF|PI|FF|FI)_(?P<base>[A-Z0-9]+?)(?P<quote>{_QUOTES})(?:_(?P<expiry>\d+))?$')
+_GENERIC = re.compile(rf'^(?P<base>[A-Z0-9]+?)[-_/]?(?P<quote>{_QUOTES})$')
+_KRAKEN_KINDS = {'PF': PERPETUAL, 'PI': INVERSE_PERPETUAL, 'FF': FUTURE, 'FI': FUTURE}
+
+RULES = {
+    'BINANCE': _LINEAR,
+    'APOLLOX': _LINEAR,
+    'DYDX': _DASHED,
+    'KRAKEN': _KRAKEN,
+}
+
+
+class Symbol(NamedTuple):
+    base: str
+    quote: str
+    contract: str
+
+
+def parse(exchange: str, symbol: str):
+    """Symbol from the exchange's naming rule, None if the name does not fit it"""
+    match = RULES.get(exchange, _GENERIC).match(symbol.upper())
+    if not match:
+        return None
+    parts = match.groupdict()
+    base = ALIASES.get(parts['base'], parts['base'])
+    if kind := parts.get('kind'):
+        contract = _KRAKEN_KINDS[kind]
+    else:
+        contract = FUTURE if parts.get('expiry') else PERPETUAL
+    return Symbol(base, parts['quote'], contract)
+
+
+class SymbolTable:
+    """
+    Memoized exchange symbol <-> coin mapping. Built from client.markets (coin -> symbol) and
+    client.instruments of every account's client on the exchange, names outside markets are parsed
+    with the exchange rule once. Unknown symbols are cached too, until some client's markets change.
+    """
+    __slots__ = 'clients', 'loaded', 'symbols', 'coins', 'missing'
+
+    def __init__(self):
+        self.clients = {}
+        self.loaded = {}
+        self.symbols = {}
+        self.coins = {}
+        self.missing = set()
+
+    def add_exchange(self, exchange: str, client, account: str = None) -> None:
+        self.clients[(account, exchange)] = client
+        self._load(exchange)
+
+    def _load(self, exchange: str) -> None:
+        for key, client in self.clients.items():
+            if key[1] != exchange:
+                continue
+            markets = dict(getattr(client, 'markets', None) or {})
+            for coin, symbol in markets.items():
+                # markets keys are the coin names the rest of the balancer uses, they win over parsing
+                parsed = parse(exchange, symbol)
+                self.symbols[(exchange, symbol)] = Symbol(coin, parsed.quote if parsed else '',
+                                                          parsed.contract if parsed else PERPETUAL)
+                self.coins[(exchange, coin)] = symbol
+            for symbol in getattr(client, 'instruments', None) or {}:
+                if (exchange, symbol) not in self.symbols and (parsed := parse(exchange, symbol)):
+                    self.symbols[(exchange, symbol)] = parsed
+            self.loaded[key] = len(markets)
+        self.missing = {key for key in self.missing if key[0] != exchange}
+
+    def _stale(self, exchange: str) -> bool:
+        return any(len(getattr(client, 'markets', None) or {}) != self.loaded.get(key)
+                   for key, client in self.clients.items() if key[1] == exchange)
+
+    def normalize(self, exchange: str, symbol: str):
+        """:return: Symbol(base, quote, contract) or None"""
+        key = (exchange, symbol)
+        if self._stale(exchange):
+            self._load(exchange)
+        if (info := self.symbols.get(key)) or key in self.missing:
+            return info
+        if info := parse(exchange, symbol):
+            self.symbols[key] = info
+        else:
+            self.missing.add(key)
+        return info
+
+    def normalize_many(self, exchange: str, symbols) -> dict:
+        """{symbol: Symbol or None} for every distinct symbol, for ingesting record batches"""
+        return {symbol: self.normalize(exchange, symbol) for symbol in set(symbols)}
+
+    def coin(self, exchange: str, symbol: str):
+        if info := self.normalize(exchange, symbol):
+            return info.base
+
+    def symbol(self, exchange: str, coin: str):
+        """Exchange symbol trading coin, None if the exchange has no market for it"""
+        if self._stale(exchange):
+            self._load(exchange)
+        coin = coin.upper()
+        return self.coins.get((exchange, coin)) or self.coins.get((exchange, ALIASES.get(coin, coin)))
+
+
+symbols = SymbolTable()
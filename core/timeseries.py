@@ -0,0 +1,94 @@
+from array import array
+
+
+class RingSeries:
+    """
+    Fixed-capacity time series on two preallocated arrays. Appends are O(1), locating
+    the value N seconds back is a binary search, windowed scans touch only the window.
+    """
+    __slots__ = 'capacity', 'times', 'values', 'head', 'count'
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.count = 0
+
+    def append(self, ts: float, value: float) -> None:
+        self.times[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _index(self, i: int) -> int:
+        """Physical index of the i-th oldest point"""
+        return (self.head - self.count + i) % self.capacity
+
+    def last(self):
+        if self.count:
+            return self.values[self._index(self.count - 1)]
+
+    def _first_in_window(self, since: float) -> int:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self._index(middle)] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def delta(self, window: float, now: float = None):
+        """Change of value since the oldest point inside the last window seconds"""
+        if not self.count:
+            return None
+        now = now if now is not None else self.times[self._index(self.count - 1)]
+        start = self._first_in_window(now - window)
+        if start >= self.count:
+            return None
+        return self.values[self._index(self.count - 1)] - self.values[self._index(start)]
+
+    def max_drawdown(self, window: float, now: float = None) -> float:
+        """Largest relative fall from a running peak inside the window, 0.1 is -10%"""
+        if not self.count:
+            return 0
+        now = now if now is not None else self.times[self._index(self.count - 1)]
+        peak = None
+        drawdown = 0
+        for i in range(self._first_in_window(now - window), self.count):
+            value = self.values[self._index(i)]
+            if peak is None or value > peak:
+                peak = value
+            elif peak > 0:
+                drawdown = max(drawdown, (peak - value) / peak)
+        return drawdown
+
+
+class PositionHistory:
+    """
+    Memory-bounded history of positions per (coin, exchange) and balances per exchange.
+    """
+    __slots__ = 'capacity', 'positions', 'balances'
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.positions = {}
+        self.balances = {}
+
+    def _series(self, store: dict, key) -> RingSeries:
+        if not (series := store.get(key)):
+            series = store[key] = RingSeries(self.capacity)
+        return series
+
+    def add_position(self, ts: float, coin: str, exchange: str, amount_usd: float) -> None:
+        self._series(self.positions, (coin, exchange)).append(ts, amount_usd)
+
+    def add_balance(self, ts: float, exchange: str, balance: float) -> None:
+        self._series(self.balances, exchange).append(ts, balance)
+
+    def balance_series(self, exchange: str):
+        return self.balances.get(exchange)
+
+    def position_series(self, coin: str, exchange: str):
+        return self.positions.get((coin, exchange))
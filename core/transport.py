@@ -0,0 +1,209 @@
+import asyncio
+import os
+import struct
+
+import msgpack
+
+FRAME_HEADER = struct.Struct('<I')
+# one byte the consumer side answers every frame with
+DELIVERED = b'\x01'
+REFUSED = b'\x00'
+
+
+class LocalMessage:
+    """Same surface the consumer uses on aio_pika incoming messages"""
+    __slots__ = 'routing_key', 'body', 'content_type', 'headers', 'message_id'
+
+    def __init__(self, routing_key: str, body: bytes, content_type: str = None, headers: dict = None,
+                 message_id: str = None):
+        self.routing_key = routing_key
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.message_id = message_id
+
+    async def ack(self) -> None:
+        """Local delivery is at-most-once, there is nothing to acknowledge"""
+
+
+class LocalQueue:
+    """
+    Consumer side of a local queue with the aio_pika Queue calls the consumer relies on:
+    consume(callback) -> tag and cancel(tag). Every message runs callback in its own task.
+    """
+    __slots__ = 'name', 'callbacks', 'tasks'
+
+    def __init__(self, name: str):
+        self.name = name
+        self.callbacks = {}
+        self.tasks = set()
+
+    async def consume(self, callback) -> str:
+        tag = f"{self.name}-{len(self.callbacks)}-{id(callback)}"
+        self.callbacks[tag] = callback
+        return tag
+
+    async def cancel(self, tag: str) -> None:
+        self.callbacks.pop(tag, None)
+
+    def deliver(self, message: LocalMessage) -> bool:
+        if not self.callbacks:
+            return False
+        callback = next(iter(self.callbacks.values()))
+        task = asyncio.get_event_loop().create_task(callback(message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+
+class InProcessTransport:
+    """Queues inside one event loop, for single-process setups and running the stack without a broker"""
+    __slots__ = 'queues'
+
+    def __init__(self):
+        self.queues = {}
+
+    def queue(self, name: str) -> LocalQueue:
+        if not (queue := self.queues.get(name)):
+            queue = self.queues[name] = LocalQueue(name)
+        return queue
+
+    async def listen(self, name: str) -> LocalQueue:
+        return self.queue(name)
+
+    async def publish(self, queue_name: str, routing_key: str, body: bytes, content_type: str = None,
+                      headers: dict = None, message_id: str = None) -> bool:
+        return self.queue(queue_name).deliver(LocalMessage(routing_key, body, content_type, headers, message_id))
+
+    async def close(self) -> None:
+        self.queues = {}
+
+
+class UnixSocketTransport:
+    """
+    Queues between processes on one host: the consumer of a queue listens on <directory>/<queue>.sock,
+    publishers keep one stream per queue and write length-prefixed msgpack frames. The consumer side
+    answers every frame with DELIVERED once a callback took the message, or REFUSED while the queue has
+    no consumer (paused, cancelled). publish() returns False when nobody listens, the message was refused
+    or no answer came within timeout, the caller then goes through RabbitMQ.
+    """
+    __slots__ = 'directory', 'timeout', 'streams', 'locks', 'servers', 'queues'
+
+    def __init__(self, directory: str, timeout: float = 5):
+        self.directory = directory
+        self.timeout = timeout
+        self.streams = {}
+        self.locks = {}
+        self.servers = {}
+        self.queues = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, queue_name: str) -> str:
+        return os.path.join(self.directory, f"{queue_name}.sock")
+
+    async def listen(self, name: str):
+        """LocalQueue for name, None if another process already serves it"""
+        if name in self.queues:
+            return self.queues[name]
+        path = self.path(name)
+        if os.path.exists(path):
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                writer.close()
+                return None
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path)
+        queue = self.queues[name] = LocalQueue(name)
+        self.servers[name] = await asyncio.start_unix_server(
+            lambda reader, writer: self._serve(queue, reader, writer), path=path)
+        return queue
+
+    @staticmethod
+    async def _serve(queue: LocalQueue, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                size, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                routing_key, content_type, headers, message_id, body = msgpack.unpackb(
+                    await reader.readexactly(size), raw=False)
+                delivered = queue.deliver(LocalMessage(routing_key, body, content_type, headers, message_id))
+                writer.write(DELIVERED if delivered else REFUSED)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def publish(self, queue_name: str, routing_key: str, body: bytes, content_type: str = None,
+                      headers: dict = None, message_id: str = None) -> bool:
+        frame = msgpack.packb([routing_key, content_type, headers or {}, message_id, body], use_bin_type=True)
+        if not (lock := self.locks.get(queue_name)):
+            lock = self.locks[queue_name] = asyncio.Lock()
+        # one frame in flight per stream, so every answer belongs to the frame just written
+        async with lock:
+            try:
+                stream = self.streams.get(queue_name)
+                if not stream or stream[1].is_closing():
+                    stream = self.streams[queue_name] = await asyncio.open_unix_connection(self.path(queue_name))
+                reader, writer = stream
+                writer.write(FRAME_HEADER.pack(len(frame)) + frame)
+                await writer.drain()
+                return await asyncio.wait_for(reader.readexactly(1), self.timeout) == DELIVERED
+            except (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, FileNotFoundError,
+                    asyncio.IncompleteReadError, asyncio.TimeoutError):
+                # without an answer the frame may or may not have been taken, start over on a new stream
+                if stream := self.streams.pop(queue_name, None):
+                    stream[1].close()
+                return False
+
+    async def close(self) -> None:
+        for _, writer in self.streams.values():
+            writer.close()
+        for name, server in self.servers.items():
+            server.close()
+            if os.path.exists(self.path(name)):
+                os.unlink(self.path(name))
+        self.streams = {}
+        self.locks = {}
+        self.servers = {}
+        self.queues = {}
+
+
+class Transport:
+    """
+    Routes queues listed in LOCAL_QUEUES to a local backend, everything else stays on RabbitMQ.
+    :param local_queues: queue names delivered locally
+    :param backend: InProcessTransport or UnixSocketTransport, None disables local delivery
+    """
+    __slots__ = 'local_queues', 'backend'
+
+    def __init__(self, local_queues=(), backend=None):
+        self.local_queues = set(local_queues)
+        self.backend = backend
+
+    def is_local(self, queue_name: str) -> bool:
+        return bool(self.backend) and ('*' in self.local_queues or queue_name in self.local_queues)
+
+    async def publish(self, queue_name: str, routing_key: str, body: bytes, content_type: str = None,
+                      headers: dict = None, message_id: str = None) -> bool:
+        """True if delivered locally, False means publish it to RabbitMQ"""
+        if not self.is_local(queue_name):
+            return False
+        return await self.backend.publish(queue_name, routing_key, body, content_type, headers, message_id)
+
+    async def listen(self, queue_name: str):
+        if self.is_local(queue_name):
+            return await self.backend.listen(queue_name)
+
+
+def transport_from_config(settings) -> Transport:
+    """
+    [SETTINGS] LOCAL_QUEUES = logger.event.check_balance,...  (* for all)
+               LOCAL_TRANSPORT = unix | memory, default unix
+               LOCAL_SOCKET_DIR = directory for unix sockets
+    """
+    local_queues = [x.strip() for x in settings.get('LOCAL_QUEUES', '').split(',') if x.strip()]
+    if not local_queues:
+        return Transport()
+    if settings.get('LOCAL_TRANSPORT', 'unix') == 'memory':
+        return Transport(local_queues, InProcessTransport())
+    return Transport(local_queues, UnixSocketTransport(settings.get('LOCAL_SOCKET_DIR', '/tmp/balancing_queues')))
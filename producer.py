@@ -2,9 +2,11 @@ import asyncio
 import logging
 from logging.config import dictConfig
 import orjson
-from aio_pika import connect, ExchangeType, Message
+from aio_pika import connect_robust, ExchangeType, Message
 from tasks.all_tasks import PERIODIC_TASKS
 from core.wrappers import try_exc_async
+from core.scheduler import PeriodicScheduler
+from core.transport import transport_from_config
 
 import configparser
 import sys
@@ -26,34 +28,57 @@ class WorkerProducer:
         rabbit = config['RABBIT']
         self.rabbit_url = f"amqp://{rabbit['USERNAME']}:{rabbit['PASSWORD']}@{rabbit['HOST']}:{rabbit['PORT']}/"
         self.periodic_tasks = []
+        self.connection = None
+        self.channel = None
+        self.exchanges = {}
+        self.queues = {}
+        # per queue: messages published so far, and the sequence number of each job's latest message
+        self.published = {}
+        self.pending = {}
+        self.transport = transport_from_config(config['SETTINGS'])
 
     @try_exc_async
     async def run(self):
-        for task in PERIODIC_TASKS:
-            self.periodic_tasks.append(self.loop.create_task(self._publishing_task(task)))
+        await self.connect()
+        scheduler = PeriodicScheduler(PERIODIC_TASKS, self._publish)
+        self.periodic_tasks.append(self.loop.create_task(scheduler.run()))
 
     @try_exc_async
-    async def _publishing_task(self, task):
-        if task['delay']:
-            await asyncio.sleep(task['delay'])
-
-        while True:
-            connection = await connect(url=self.rabbit_url, loop=self.loop)
-
-            channel = await connection.channel()
-
-            exchange = await channel.declare_exchange(task['exchange'], type=ExchangeType.DIRECT, durable=True)
-            queue = await channel.declare_queue(task['queue'], durable=True)
+    async def connect(self):
+        self.connection = await connect_robust(url=self.rabbit_url, loop=self.loop)
+        self.channel = await self.connection.channel()
+
+    async def _declare(self, task):
+        if task['queue'] not in self.queues:
+            exchange = await self.channel.declare_exchange(task['exchange'], type=ExchangeType.DIRECT, durable=True)
+            queue = await self.channel.declare_queue(task['queue'], durable=True)
             await queue.bind(exchange, routing_key=task['routing_key'])
+            self.exchanges[task['queue']] = exchange
+            self.queues[task['queue']] = queue
+        return self.exchanges[task['queue']], self.queues[task['queue']]
 
-            message = Message(orjson.dumps(task['payload']) if task.get('payload') else b'{}')
-            await exchange.publish(message, routing_key=task['routing_key'])
-
-            logger.info(f'Published message to queue {task["queue"]}')
-
-            await connection.close()
-
-            await asyncio.sleep(task['interval'])
+    @try_exc_async
+    async def _publish(self, task):
+        body = orjson.dumps(task['payload']) if task.get('payload') else b'{}'
+        if await self.transport.publish(task['queue'], task['routing_key'], body):
+            logger.info(f'Published message to local queue {task["queue"]}')
+            return
+        exchange, queue = await self._declare(task)
+        declared = await queue.declare()
+        # queues are FIFO: of the messages published here, all but the last message_count were taken already
+        published = self.published.get(task['queue'], 0)
+        consumed = published - declared.message_count
+        pending = self.pending.setdefault(task['queue'], {})
+        if pending.get(id(task), 0) > consumed:
+            logger.info(f'Skip {task["routing_key"]}: previous run still queued ({declared.message_count} messages)')
+            return
+
+        message = Message(body)
+        await exchange.publish(message, routing_key=task['routing_key'])
+        self.published[task['queue']] = published + 1
+        pending[id(task)] = published + 1
+
+        logger.info(f'Published message to queue {task["queue"]}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import argparse
+import importlib
+import time
+
+from core.selection import select_exchange
+from core.shadow import read_decisions
+
+
+def load_selector(path: str):
+    if not path:
+        return select_exchange
+    module_name, func_name = path.split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def replay(decisions_path: str, selector, min_disbalance: float = 0.0) -> dict:
+    """
+    Re-run recorded balancing snapshots through a selection function offline.
+    Selector has select_exchange signature: (venues, size, side) -> (exchange, price, size)
+    """
+    stats = {'decisions': 0, 'skipped': 0, 'same_exchange': 0, 'changed': [], 'elapsed': 0.0, 'recorded_ms': 0.0}
+    time_start = time.perf_counter()
+    for decision in read_decisions(decisions_path):
+        if abs(decision['disbalance_usd']) <= min_disbalance:
+            stats['skipped'] += 1
+            continue
+        stats['decisions'] += 1
+        stats['recorded_ms'] += decision['latency_ms']
+        exchange, price, size = selector(decision['venues'], abs(decision['disbalance_coin']), decision['side'])
+        if exchange == decision['exchange']:
+            stats['same_exchange'] += 1
+        else:
+            stats['changed'].append((decision['ts'], decision['coin'], decision['side'],
+                                     decision['exchange'], exchange, decision['price'], price))
+    stats['elapsed'] = time.perf_counter() - time_start
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded balancing decisions through selection logic')
+    parser.add_argument('decisions', help='decision log written by shadow balancing')
+    parser.add_argument('--selector', default='', help='module:function to replay with, default core.selection')
+    parser.add_argument('--min-disbalance', type=float, default=0.0, help='re-apply MIN_DISBALANCE, USD')
+    args = parser.parse_args()
+
+    result = replay(args.decisions, load_selector(args.selector), args.min_disbalance)
+    for ts, coin, side, old_exchange, new_exchange, old_price, new_price in result['changed']:
+        print(f"{ts:.3f} {coin} {side}: {old_exchange} @ {old_price} -> {new_exchange} @ {new_price}")
+    print(f"DECISIONS: {result['decisions']} (SKIPPED: {result['skipped']})")
+    print(f"SAME EXCHANGE: {result['same_exchange']}, CHANGED: {len(result['changed'])}")
+    if result['elapsed'] and result['decisions']:
+        speedup = result['recorded_ms'] / 1000 / result['elapsed']
+        print(f"REPLAY TIME, S: {round(result['elapsed'], 4)} ({round(speedup, 1)}x recorded decision latency)")
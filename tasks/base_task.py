@@ -1,45 +1,133 @@
-import orjson
+import asyncio
+import uuid
 from aio_pika import Message, ExchangeType, connect_robust
 from clients.core.all_clients import ALL_CLIENTS
 from core.wrappers import try_exc_async
+from core.snapshots import RecordingClient, ReplayClient, get_reader, get_recorder
+from core import codec
+from core.rate_limiter import limiter, limits_from_config
+from core.client_adapter import AsyncClient
+from core.transport import transport_from_config
+from core.symbols import symbols
 import configparser
 import sys
 config = configparser.ConfigParser()
 config.read(sys.argv[1], "utf-8")
 
-leverage = float(config['SETTINGS']['LEVERAGE'])
+limiter.limits.update(limits_from_config(config['RATE_LIMITS'] if config.has_section('RATE_LIMITS') else {}))
+limiter.share(config['SETTINGS'].get('RATE_LIMIT_DIR', 'rate_limits'))
+binary_routing_keys = [x.strip() for x in config['SETTINGS'].get('BINARY_ROUTING_KEYS', '').split(',') if x.strip()]
+transport = transport_from_config(config['SETTINGS'])
 
 
 class BaseTask:
-    __slots__ = 'mq', 'clients', 'chat_id', 'chat_token', 'alert_id', 'alert_token', 'exchanges'
+    __slots__ = 'mq', 'clients', 'chat_id', 'chat_token', 'alert_id', 'alert_token', 'exchanges', 'config', \
+                'outbox', 'account'
 
-    def __init__(self):
+    def __init__(self, account_config: configparser.ConfigParser = None):
         self.mq = None
-        self.chat_id = int(config['TELEGRAM']['CHAT_ID'])
-        self.chat_token = config['TELEGRAM']['TOKEN']
-        self.alert_id = int(config['TELEGRAM']['ALERT_CHAT_ID'])
-        self.exchanges = config['SETTINGS']['EXCHANGES'].split(',')
+        self.outbox = None
+        self.config = account_config or config
+        # order budgets, symbol clients and request timings of different accounts in one process stay apart
+        self.account = self.config['SETTINGS'].get('ACCOUNT', self.config['SETTINGS'].get('ENV'))
+        self.chat_id = int(self.config['TELEGRAM']['CHAT_ID'])
+        self.chat_token = self.config['TELEGRAM']['TOKEN']
+        self.alert_id = int(self.config['TELEGRAM']['ALERT_CHAT_ID'])
+        self.exchanges = self.config['SETTINGS']['EXCHANGES'].split(',')
         self.clients = {}
+        leverage = float(self.config['SETTINGS']['LEVERAGE'])
+        if replay_path := self.config['SETTINGS'].get('SNAPSHOT_REPLAY'):
+            reader = get_reader(replay_path)
+            for exchange in self.exchanges:
+                client = ReplayClient(exchange, reader, leverage=leverage)
+                self.clients.update({exchange: AsyncClient(client, exchange, account=self.account)})
+                symbols.add_exchange(exchange, self.clients[exchange], self.account)
+            return
+        record_path = self.config['SETTINGS'].get('SNAPSHOT_RECORD')
         for exchange in self.exchanges:
-            client = ALL_CLIENTS[exchange](keys=config[exchange], leverage=leverage, state='Balancer')
-            self.clients.update({exchange: client})
+            client = ALL_CLIENTS[exchange](keys=self.config[exchange], leverage=leverage, state='Balancer')
+            if record_path:
+                client = RecordingClient(client, exchange, get_recorder(record_path))
+            self.clients.update({exchange: AsyncClient(client, exchange, account=self.account)})
+            symbols.add_exchange(exchange, self.clients[exchange], self.account)
 
     @staticmethod
     @try_exc_async
     async def publish_message(connect, message, routing_key, exchange_name, queue_name):
+        message_body, content_type, headers = BaseTask.encode_message(message, routing_key)
+        if await transport.publish(queue_name, routing_key, message_body, content_type, headers):
+            return True
         channel = await connect.channel()
         exchange = await channel.declare_exchange(exchange_name, type=ExchangeType.DIRECT, durable=True)
         queue = await channel.declare_queue(queue_name, durable=True)
         await queue.bind(exchange, routing_key=routing_key)
-        message_body = orjson.dumps(message)
-        message = Message(message_body)
+        message = Message(message_body, content_type=content_type, headers=headers)
         await exchange.publish(message, routing_key=routing_key)
         await channel.close()
         return True
 
+    @staticmethod
+    def encode_message(message, routing_key: str) -> tuple:
+        binary = '*' in binary_routing_keys or routing_key in binary_routing_keys
+        return codec.encode(message, routing_key, binary)
+
+    @try_exc_async
+    async def enqueue_message(self, message, routing_key, exchange_name, queue_name):
+        """
+        Write the message to the outbox and return at once, the drainer publishes it.
+        Without an outbox this is publish_message.
+        """
+        if not self.outbox:
+            return await self.publish_message(connect=self.mq, message=message, routing_key=routing_key,
+                                              exchange_name=exchange_name, queue_name=queue_name)
+        record_id = (message.get('id') or message.get('parent_id')) if isinstance(message, dict) else None
+        key = f"{routing_key}:{record_id}" if record_id else f"{routing_key}:{uuid.uuid4()}"
+        message_body, content_type, headers = self.encode_message(message, routing_key)
+        self.outbox.put(key, routing_key, exchange_name, queue_name, message_body, content_type, headers)
+        return True
+
+    @staticmethod
+    async def publish_batch(connect, rows: list) -> list:
+        """
+        Publish outbox rows on one confirming channel, rows for local queues go through the transport.
+        Errors are raised to the drainer, which backs off and alerts once instead of on every retry.
+        :return: keys the broker acknowledged or delivered locally
+        """
+        delivered = []
+        remote = []
+        for row in rows:
+            key, routing_key, _, queue_name, body, content_type, headers = row
+            if await transport.publish(queue_name, routing_key, body, content_type, headers, key):
+                delivered.append(key)
+            else:
+                remote.append(row)
+        if not remote:
+            return delivered
+        if not connect or connect.is_closed:
+            raise ConnectionError('broker connection is not open')
+        rows = remote
+        channel = await connect.channel(publisher_confirms=True)
+        exchanges = {}
+        for _, routing_key, exchange_name, queue_name, _, _, _ in rows:
+            if (exchange_name, queue_name, routing_key) not in exchanges:
+                exchange = await channel.declare_exchange(exchange_name, type=ExchangeType.DIRECT, durable=True)
+                queue = await channel.declare_queue(queue_name, durable=True)
+                await queue.bind(exchange, routing_key=routing_key)
+                exchanges[(exchange_name, queue_name, routing_key)] = exchange
+
+        async def publish(row) -> str:
+            key, routing_key, exchange_name, queue_name, body, content_type, headers = row
+            message = Message(body, content_type=content_type, headers=headers, message_id=key)
+            await exchanges[(exchange_name, queue_name, routing_key)].publish(message, routing_key=routing_key)
+            return key
+
+        results = await asyncio.gather(*[publish(row) for row in rows], return_exceptions=True)
+        await channel.close()
+        return delivered + [result for result in results if isinstance(result, str)]
+
     @try_exc_async
     async def setup_mq(self, event_loop) -> None:
-        rabbit = config['RABBIT']
+        rabbit = self.config['RABBIT']
         rabbit_url = f"amqp://{rabbit['USERNAME']}:{rabbit['PASSWORD']}@{rabbit['HOST']}:{rabbit['PORT']}/"
         self.mq = await connect_robust(rabbit_url, loop=event_loop)
         print('SETUP MQ')
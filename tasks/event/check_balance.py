@@ -5,21 +5,25 @@ from datetime import datetime
 
 from tasks.all_tasks import RabbitMqQueues
 from core.wrappers import try_exc_regular, try_exc_async
+from core.rate_limiter import limiter, MARKET, REPORTING
+
+ORDERBOOK_ATTEMPTS = 10
 
 
 class CheckBalance:
+    __slots__ = 'base_task', 'app', 'chat_id', 'env', 'telegram_bot', 'context', 'parent_id'
 
     def __init__(self, app, base_task):
         self.base_task = base_task
         self.app = app
+        self.reset()
 
+    def reset(self) -> None:
         self.chat_id = None
         self.env = None
         self.telegram_bot = None
         self.context = None
         self.parent_id = None
-        self.balances = []
-        self.positions = []
 
     @try_exc_async
     async def run(self, payload: dict) -> None:
@@ -38,15 +42,22 @@ class CheckBalance:
             balance_id = uuid.uuid4()
             await self.__save_balance(client, balance_id)
             for symbol in client.get_positions().copy():
-                while not client.orderbook.get(symbol):
+                for _ in range(ORDERBOOK_ATTEMPTS):
+                    if client.orderbook.get(symbol):
+                        break
                     await asyncio.sleep(0.5)
+                    await limiter.acquire(client.EXCHANGE_NAME, MARKET, REPORTING)
                     client.orderbook[symbol] = await client.get_orderbook_by_symbol(symbol)
+                if not client.orderbook.get(symbol):
+                    print(f"NO ORDERBOOK {client.EXCHANGE_NAME} {symbol}")
+                    continue
                 await self.__save_balance_detalization(symbol, client, balance_id)
 
     @try_exc_async
     async def __save_balance(self, client, balance_id) -> None:
         sum_amount_usd = sum([x.get('amount_usd', 0) for _, x in client.get_positions().items()])
         balance = client.get_balance()
+        available = client.get_available_balance()
         current_margin = round(abs(sum_amount_usd / balance), 1) if balance else 0
         message = {
             'id': balance_id,
@@ -55,9 +66,9 @@ class CheckBalance:
             'context': self.context,
             'parent_id': self.parent_id,
             'exchange': client.EXCHANGE_NAME,
-            'exchange_balance': round(client.get_balance(), 1),
-            'available_for_buy': round(client.get_available_balance()['buy'], 1),
-            'available_for_sell': round(client.get_available_balance()['sell'], 1),
+            'exchange_balance': round(balance, 1),
+            'available_for_buy': round(available['buy'], 1),
+            'available_for_sell': round(available['sell'], 1),
             'env': self.env,
             'chat_id': self.chat_id,
             'bot_token': self.telegram_bot,
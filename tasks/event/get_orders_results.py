@@ -4,10 +4,13 @@ import aiohttp
 
 from tasks.all_tasks import RabbitMqQueues
 from core.wrappers import try_exc_async
+from core.rate_limiter import limiter, MARKET, REPORTING
 
 
 class GetOrdersResults:
     __slots__ = 'app', 'clients', 'order_result', 'base_task'
+    # payload is a list of lookups, decoded one element at a time
+    LAZY_PAYLOAD = True
 
     def __init__(self, app, base_task):
         self.app = app
@@ -18,7 +21,8 @@ class GetOrdersResults:
         for data in payload:
             if not self.base_task.clients.get(data['exchange']):
                 continue
-            if res := self.base_task.clients[data['exchange']].get_order_by_id(data['symbol'], data['order_ids']):
+            await limiter.acquire(data['exchange'], MARKET, REPORTING)
+            if res := await self.base_task.clients[data['exchange']].get_order_by_id(data['symbol'], data['order_ids']):
                 await asyncio.sleep(2)
                 print(f'GET_ORDER_BY_ID {data["exchange"]}: {res=}')
                 await self.base_task.publish_message(connect=self.app['mq'],
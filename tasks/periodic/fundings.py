@@ -1,11 +1,12 @@
 import asyncio
 import uuid
 
-import aiohttp
-
 from tasks.all_tasks import RabbitMqQueues
 from tasks.base_task import BaseTask
 from core.wrappers import try_exc_regular, try_exc_async
+from core.rate_limiter import limiter, MARKET, REPORTING
+from core.client_adapter import make_session
+from core.symbols import symbols
 
 import configparser
 import sys
@@ -13,28 +14,34 @@ config = configparser.ConfigParser()
 config.read(sys.argv[1], "utf-8")
 
 
-class Funding(BaseTask):
-    __slots__ = 'clients', 'mq', 'session', 'app', 'env'
+class Funding:
+    __slots__ = 'app', 'base_task', 'env'
 
-    def __init__(self, app):
-        super().__init__()
+    def __init__(self, app, base_task: BaseTask):
         self.app = app
-        self.env = config['SETTINGS']['ENV']
+        self.base_task = base_task
+        self.env = base_task.config['SETTINGS']['ENV']
 
     @try_exc_async
     async def run(self, payload: dict) -> None:
-        async with aiohttp.ClientSession() as session:
-            await self.__get_fundings(session)
+        """
+        :param payload: optional {'coins': [...]} to save fundings of these coins only
+        """
+        coins = {coin.upper() for coin in (payload or {}).get('coins', [])}
+        async with make_session() as session:
+            await self.__get_fundings(session, coins)
 
     @try_exc_async
-    async def __get_fundings(self, session) -> None:
-        for client_name, client in self.clients.items():
+    async def __get_fundings(self, session, coins: set) -> None:
+        for client_name, client in self.base_task.clients.items():
+            await limiter.acquire(client_name, MARKET, REPORTING)
             fundings = await client.get_funding_payments(session)
+            names = symbols.normalize_many(client_name, [fund['market'] for fund in fundings if fund.get('market')])
             for fund in fundings:
-                if fund.get('datetime'):
-                    await self.save_funding(fund, client_name)
-                else:
+                if not fund.get('datetime'):
                     print(fund)
+                elif not coins or ((info := names.get(fund.get('market'))) and info.base in coins):
+                    await self.save_funding(fund, client_name)
 
     @try_exc_async
     async def save_funding(self, funding, exchange):
@@ -52,11 +59,11 @@ class Funding(BaseTask):
         }
         print(message)
 
-        await self.publish_message(connect=self.app['mq'],
-                                   message=message,
-                                   routing_key=RabbitMqQueues.FUNDINGS,
-                                   exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.FUNDINGS),
-                                   queue_name=RabbitMqQueues.FUNDINGS)
+        await self.base_task.publish_message(connect=self.app['mq'],
+                                             message=message,
+                                             routing_key=RabbitMqQueues.FUNDINGS,
+                                             exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.FUNDINGS),
+                                             queue_name=RabbitMqQueues.FUNDINGS)
 
 
 if __name__ == '__main__':
@@ -71,5 +78,5 @@ if __name__ == '__main__':
     app = Application()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(connect_to_rabbit())
-    worker = Funding(app)
+    worker = Funding(app, BaseTask())
     loop.run_until_complete(worker.run({}))
@@ -1,30 +1,50 @@
-import aiohttp
-
 from tasks.all_tasks import RabbitMqQueues
 from tasks.base_task import BaseTask
 from core.wrappers import try_exc_regular, try_exc_async
+from core.rate_limiter import limiter, MARKET, REPORTING
+from core.client_adapter import make_session
+from core.symbols import symbols
 
 
-class GetMissedOrders(BaseTask):
+class GetMissedOrders:
+    __slots__ = 'app', 'base_task'
 
-    def __init__(self, app):
-        super().__init__()
+    def __init__(self, app, base_task: BaseTask):
         self.app = app
+        self.base_task = base_task
+
+    @staticmethod
+    def targets(exchange: str, payload: dict) -> list:
+        """
+        Exchange symbols to fetch. payload is {exchange: symbol or coin} and/or {'coins': [...]},
+        coins are resolved to each exchange's own symbol.
+        """
+        targets = []
+        if requested := payload.get(exchange):
+            targets.append(requested if symbols.normalize(exchange, requested) else
+                           symbols.symbol(exchange, requested) or requested)
+        for coin in payload.get('coins', []):
+            if (symbol := symbols.symbol(exchange, coin)) and symbol not in targets:
+                targets.append(symbol)
+        return targets
 
     @try_exc_async
     async def run(self, payload: dict) -> None:
         orders = []
 
-        async with aiohttp.ClientSession() as session:
-            for client in self.clients.values():
-                orders += await client.get_all_orders(payload[client.EXCHANGE_NAME], session)
+        async with make_session() as session:
+            for client in self.base_task.clients.values():
+                for symbol in self.targets(client.EXCHANGE_NAME, payload):
+                    await limiter.acquire(client.EXCHANGE_NAME, MARKET, REPORTING)
+                    orders += await client.get_all_orders(symbol, session)
 
         # print(orders)
         for order in orders:
             if 'web-' in order['context']:
-                await self.publish_message(connect=self.app['mq'],
-                                           message=order,
-                                           routing_key=RabbitMqQueues.ORDERS,
-                                           exchange_name=RabbitMqQueues.get_exchange_name(RabbitMqQueues.ORDERS),
-                                           queue_name=RabbitMqQueues.ORDERS
-                                           )
+                await self.base_task.publish_message(connect=self.app['mq'],
+                                                     message=order,
+                                                     routing_key=RabbitMqQueues.ORDERS,
+                                                     exchange_name=RabbitMqQueues.get_exchange_name(
+                                                         RabbitMqQueues.ORDERS),
+                                                     queue_name=RabbitMqQueues.ORDERS
+                                                     )